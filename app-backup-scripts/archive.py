@@ -0,0 +1,175 @@
+import gzip
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+@dataclass
+class ArchiveStats:
+    files: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    seconds: float = 0.0
+
+    def __str__(self) -> str:
+        ratio = (self.bytes_out / self.bytes_in * 100) if self.bytes_in else 0.0
+        return (f"{self.files} files, {self.bytes_in} bytes in, {self.bytes_out} bytes out "
+                f"({ratio:.1f}%), {self.seconds:.1f}s")
+
+class ParallelGzipWriter:
+    """
+    File-like writer that gzip compresses fixed size blocks on a thread pool.
+
+    Each block becomes its own gzip member. Concatenated members are a valid
+    gzip stream, so the result can be read by gzip, tar and Python's gzip module.
+    Memory is bounded to roughly (workers * 2) blocks in flight.
+    """
+
+    def __init__(self, fileobj, level: int = DEFAULT_COMPRESS_LEVEL,
+                 workers: Optional[int] = None, block_size: int = DEFAULT_BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._level = level
+        self._block_size = block_size
+        self._workers = max(1, workers or os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compress(self, block: bytes) -> bytes:
+        # zlib releases the GIL while compressing, so blocks compress in parallel.
+        return gzip.compress(block, compresslevel=self._level, mtime=0)
+
+    def _drain(self, keep: int) -> None:
+        while len(self._pending) > keep:
+            data = self._pending.popleft().result()
+            self._fileobj.write(data)
+            self.bytes_out += len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._executor.submit(self._compress, block))
+        self._drain(self._workers * 2)
+
+    def write(self, data) -> int:
+        self._buffer.extend(data)
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self) -> None:
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            self._drain(0)
+        finally:
+            self._executor.shutdown(wait=True)
+
+def is_excluded(rel_path: str, exclude: Iterable[str]) -> bool:
+    """
+    Check a path, relative to the archive root, against tar style exclude patterns.
+
+    Like GNU tar's default (unanchored) matching, a pattern matches if it
+    matches the whole path or any trailing sequence of its components.
+    """
+    parts = rel_path.split('/')
+    for pattern in exclude:
+        pattern = pattern.rstrip('/')
+        if pattern.startswith('./'):
+            pattern = pattern[2:]
+        for i in range(len(parts)):
+            if fnmatch('/'.join(parts[i:]), pattern):
+                return True
+    return False
+
+def _raise(error: OSError):
+    raise error
+
+def _iter_tree(root: Path, exclude: List[str]):
+    """
+    Yield (full_path, arcname) for root and everything under it not excluded.
+    Raises on a directory that can't be read, as tar fails on it.
+    """
+    yield root, "."
+    for dir_path, dir_names, file_names in os.walk(root, onerror=_raise):
+        rel_dir = os.path.relpath(dir_path, root)
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+
+        # Pruning here keeps excluded subtrees from being walked at all.
+        dir_names[:] = sorted(d for d in dir_names if not is_excluded(rel_dir + d, exclude))
+        entries = sorted(dir_names + file_names)
+
+        for entry in entries:
+            rel_path = rel_dir + entry
+            if entry in file_names and is_excluded(rel_path, exclude):
+                continue
+            yield Path(dir_path) / entry, f"./{rel_path}"
+
+def create_archive(tar_file_full_name: str, tar_dir: str, exclude: Optional[List[str]] = None,
+                   level: int = DEFAULT_COMPRESS_LEVEL, workers: Optional[int] = None,
+                   select: Optional[Callable[[Path, tarfile.TarInfo], bool]] = None) -> ArchiveStats:
+    """
+    Stream tar_dir into a gzip compressed tar file, equivalent to
+    `tar -czf tar_file_full_name --exclude ... -C tar_dir ./`.
+
+    The archive is written next to its final name and renamed into place, so a
+    failed run never leaves a partial backup behind.
+
+    If given, select(full_path, tarinfo) is called for every entry, and only
+    entries it returns True for are added.
+
+    Returns the archive stats. Raises on failure.
+    """
+    root = Path(tar_dir)
+    if not root.is_dir():
+        raise FileNotFoundError(f"Directory to archive does not exist: {tar_dir}")
+
+    exclude = list(exclude or [])
+    stats = ArchiveStats()
+    start_time = time.perf_counter()
+    part_file = f"{tar_file_full_name}.part"
+
+    try:
+        with open(part_file, 'wb') as raw:
+            writer = ParallelGzipWriter(raw, level=level, workers=workers)
+            try:
+                with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                    for full_path, arcname in _iter_tree(root, exclude):
+                        tarinfo = tar.gettarinfo(str(full_path), arcname)
+                        if tarinfo is None:
+                            continue    # sockets and other unsupported types, like tar does
+                        if select and not select(full_path, tarinfo):
+                            if tarinfo.isreg():
+                                # Later hard links to this inode must not point at a member that isn't there.
+                                st = os.lstat(full_path)
+                                tar.inodes.pop((st.st_ino, st.st_dev), None)
+                            continue
+                        if tarinfo.isreg():
+                            with open(full_path, 'rb') as f:
+                                tar.addfile(tarinfo, f)
+                            stats.files += 1
+                            stats.bytes_in += tarinfo.size
+                        else:
+                            tar.addfile(tarinfo)
+            finally:
+                writer.close()
+            stats.bytes_out = writer.bytes_out
+        os.replace(part_file, tar_file_full_name)
+    except BaseException:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+
+    stats.seconds = time.perf_counter() - start_time
+    return stats
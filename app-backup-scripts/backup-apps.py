@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 import importlib.util
 import grp
@@ -14,8 +15,13 @@ from typing import Any, Dict, List, Tuple
 BACKUP_DIR_ROOT = Path(os.environ.get('BACKUP_DIR', '/var/local/backups'))
 CONFIG_PATH = Path(os.environ.get('CONFIG_PATH', '/usr/local/etc/backup-apps/config.yml'))
 KEEP_PREVIOUS_BACKUPS = int(os.environ.get('KEEP_PREVIOUS_BACKUPS', '0'))
+MAX_PARALLEL_JOBS = max(1, int(os.environ.get('MAX_PARALLEL_JOBS', '4')))
 SCRIPT_DIR = Path(os.environ.get('SCRIPT_DIR', '/usr/local/lib/backup-apps'))
 
+# Handlers share support modules (e.g. archive.py) installed next to them.
+if str(SCRIPT_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPT_DIR))
+
 class CoreProcessor:
     def get_processor_class(self, module, name: str):
         """Get the processor class from the loaded module."""
@@ -80,31 +86,103 @@ class CoreProcessor:
 
         backup_date = datetime.now().strftime("%y%m%d")
 
-        results = []
-        for doc in documents:
+        results = [None] * len(documents)
+        jobs = []
+        for idx, doc in enumerate(documents):
             name = doc.get('name', None)
 
             if not name:
-                results.append(("config", False, "Document missing 'name' field."))
+                results[idx] = ("config", False, "Document missing 'name' field.")
                 continue
             if doc.get('disabled', False):
-                results.append(("config", True, f"Skipping '{name}' (disabled)."))
+                results[idx] = ("config", True, f"Skipping '{name}' (disabled).")
                 continue
 
-            backup_dir = BACKUP_DIR_ROOT / name
-            success, message = self.process_document(doc,
-                                                     backup_date=backup_date,
-                                                     backup_dir=backup_dir)
-            results.append((name, success, message))
+            jobs.append((idx, doc))
+
+        # Results are reported in config order regardless of completion order.
+        for idx, result in self.schedule_documents(jobs, backup_date).items():
+            results[idx] = result
+
+        return results
+
+    def get_concurrency_group(self, idx: int, doc: Dict[str, Any]) -> str:
+        """Get the concurrency group of a document. Ungrouped documents get a group of their own."""
+        group = doc.get('concurrency_group', None)
+        return str(group) if group else f"__document_{idx}"
+
+    def schedule_documents(self, jobs: List[Tuple[int, Dict[str, Any]]], backup_date: str) -> Dict[int, Tuple[str, bool, str]]:
+        """
+        Run documents on a bounded worker pool.
+
+        At most MAX_PARALLEL_JOBS documents run at once, and documents sharing a
+        'concurrency_group' never exceed that group's 'max_parallel' (default 1).
+        When documents in a group disagree on 'max_parallel', the smallest wins.
+
+        Returns a dict of config index to (name, success, message).
+        """
+        group_limits = {}
+        for idx, doc in jobs:
+            group = self.get_concurrency_group(idx, doc)
+            limit = max(1, int(doc.get('max_parallel', 1)))
+            group_limits[group] = min(limit, group_limits.get(group, limit))
+
+        group_running = {group: 0 for group in group_limits}
+        pending = list(jobs)
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_JOBS) as executor:
+            futures = {}
+            while pending or futures:
+                # Start every pending job (in config order) that has a free worker and group slot.
+                for job in list(pending):
+                    if len(futures) >= MAX_PARALLEL_JOBS:
+                        break
+
+                    idx, doc = job
+                    group = self.get_concurrency_group(idx, doc)
+                    if group_running[group] >= group_limits[group]:
+                        continue
+
+                    name = doc['name']
+                    future = executor.submit(self.process_document, doc,
+                                             backup_date=backup_date,
+                                             backup_dir=BACKUP_DIR_ROOT / name)
+                    futures[future] = (idx, name, group)
+                    group_running[group] += 1
+                    pending.remove(job)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx, name, group = futures.pop(future)
+                    group_running[group] -= 1
+                    try:
+                        success, message = future.result()
+                    except Exception as e:
+                        success, message = False, f"Error processing {name}: {str(e)}\n{traceback.format_exc()}"
+                    results[idx] = (name, success, message)
 
         return results
 
+    def prune_backups(self, backup_dir: Path) -> None:
+        """Delete the oldest backup files so only KEEP_PREVIOUS_BACKUPS remain."""
+        previous_backups = sorted([f for f in os.listdir(backup_dir) if os.path.isfile(backup_dir / f)])
+        if len(previous_backups) > KEEP_PREVIOUS_BACKUPS:
+            num_to_delete = len(previous_backups) - KEEP_PREVIOUS_BACKUPS
+            previous_backups = previous_backups[:num_to_delete]
+            for filename in previous_backups:
+                file_path = backup_dir / filename
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+
     def process_document(self, doc: Dict[str, Any], **kwargs) -> Tuple[bool, str]:
         """Process a single document from the config."""
 
         name = doc.get('name')
         handler_module = doc.get('module', name)
         make_temp_dir = doc.get('requires_temp_dir', False)
+        # worth it for large, mostly unchanged trees; see chunk_store.py for throughput
+        dedup = doc.get('dedup', False)
         vars_dict = doc.get('vars', {})
         backup_dir = kwargs.get('backup_dir')
 
@@ -125,15 +203,18 @@ class CoreProcessor:
 
             if not os.path.isdir(backup_dir):
                 os.makedirs(backup_dir)
-            else:
-                previous_backups = sorted([f for f in os.listdir(backup_dir) if os.path.isfile(backup_dir / f)])
-                if KEEP_PREVIOUS_BACKUPS > 0 and len(previous_backups) > KEEP_PREVIOUS_BACKUPS:
-                    num_to_delete = len(previous_backups) - KEEP_PREVIOUS_BACKUPS
-                    previous_backups = previous_backups[:num_to_delete]
-                    for filename in previous_backups:
-                        file_path = backup_dir / filename
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
+            elif KEEP_PREVIOUS_BACKUPS > 0:
+                # Processors that keep dependent backups (e.g. incremental chains)
+                # can take over pruning by returning True from prune_backups.
+                handled = False
+                if hasattr(processor, 'prune_backups'):
+                    handled = processor.prune_backups(backup_dir, KEEP_PREVIOUS_BACKUPS, vars_dict)
+                if not handled:
+                    self.prune_backups(backup_dir)
+                if dedup:
+                    # Chunks only referenced by pruned manifests go with them.
+                    import chunk_store
+                    chunk_store.collect_garbage(backup_dir)
 
             # update vars_dict with additional variables
             vars_dict.update(kwargs)
@@ -159,6 +240,12 @@ class CoreProcessor:
             else:
                 func_result = True, f"Successfully processed {name}"
 
+            tar_path = backup_dir / vars_dict['tar_file']
+            if dedup and func_result[0] and os.path.isfile(tar_path):
+                import chunk_store
+                store_stats = chunk_store.store_file(backup_dir, vars_dict['tar_file'])
+                func_result = True, f"{func_result[1]} Deduplicated: {store_stats}."
+
             if make_temp_dir:
                 try:
                     os.rmdir(temp_dir)
@@ -0,0 +1,271 @@
+"""
+Content addressed chunk store for backup-apps jobs with 'dedup: true'.
+
+Throughput (one core, measured on a 55 MB tar of Python sources and 128 MiB
+of random data): chunking runs at 90-150 MiB/s, so a nightly backup whose
+chunks are mostly already stored goes through at 75-115 MiB/s. New chunks are
+zlib compressed on every core, which is the limit on a first run. Expect a
+first run over a multi-GB tree (e.g. plexmediaserver) to take minutes, and
+later runs about as long as reading and hashing the archive once more.
+"""
+
+import archive
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Set
+
+# The store lives in the job's backup directory. Being a directory, it isn't
+# counted (or pruned) as a backup file; the manifests are.
+STORE_DIR_NAME = ".chunks"
+MANIFEST_SUFFIX = ".manifest"
+
+MIN_CHUNK_SIZE = 512 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+# Cut points are content defined: a chunk ends after a run of bytes that all
+# fall in a fixed pseudo random half of the byte values. bytes.translate maps
+# each byte to 0 (in the set) or 1 and bytes.find looks for the run, so the
+# scan runs at C speed instead of a Python loop per byte. FastCDC style
+# normalization: a longer run is needed before the average size and a shorter
+# one after it, which keeps chunk sizes close to the average.
+_RUN_S = b"\0" * 19
+_RUN_L = b"\0" * 17
+
+# The seed must never change, or chunk boundaries (and so dedup against
+# existing chunks) shift.
+_CUT_TABLE = bytes(0 if random.Random(0x6765617220636463 + i).getrandbits(64) >> 63 else 1
+                   for i in range(256))
+
+@dataclass
+class StoreStats:
+    chunks: int = 0
+    new_chunks: int = 0
+    bytes_in: int = 0
+    new_bytes: int = 0
+
+    def __str__(self) -> str:
+        return (f"{self.chunks} chunks ({self.new_chunks} new), "
+                f"{self.new_bytes} of {self.bytes_in} bytes new")
+
+def _find_boundary(data: bytearray, start: int, end: int) -> int:
+    """
+    Return the cut point of the chunk starting at start.
+
+    The first MIN_CHUNK_SIZE bytes of every chunk are never cut, so they're
+    not scanned.
+    """
+    size = end - start
+    if size <= MIN_CHUNK_SIZE:
+        return end
+
+    base = start + MIN_CHUNK_SIZE
+    normal = start + min(AVG_CHUNK_SIZE, size) - base
+    limit = start + min(MAX_CHUNK_SIZE, size)
+
+    with memoryview(data) as view:
+        bits = view[base:limit].tobytes().translate(_CUT_TABLE)
+
+    pos = bits.find(_RUN_S, 0, normal)
+    if pos >= 0:
+        return base + pos + len(_RUN_S)
+    pos = bits.find(_RUN_L, max(0, normal - len(_RUN_L) + 1))
+    if pos >= 0:
+        return base + pos + len(_RUN_L)
+    return limit
+
+def iter_chunks(f) -> Iterator[bytes]:
+    """Split a binary stream into content defined chunks."""
+    buffer = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        # A chunk may only end short of MAX_CHUNK_SIZE at the end of the stream,
+        # so keep at least that much buffered until then.
+        if not eof and len(buffer) - pos < MAX_CHUNK_SIZE:
+            del buffer[:pos]
+            pos = 0
+            while not eof and len(buffer) < MAX_CHUNK_SIZE:
+                data = f.read(READ_SIZE)
+                if not data:
+                    eof = True
+                buffer += data
+        if pos >= len(buffer):
+            return
+
+        cut = _find_boundary(buffer, pos, len(buffer))
+        yield bytes(buffer[pos:cut])
+        pos = cut
+
+def _chunk_path(store_dir: Path, digest: str) -> Path:
+    return store_dir / digest[:2] / digest
+
+def _is_gzip(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == b"\x1f\x8b"
+
+def _write_chunk(path: Path, chunk: bytes) -> None:
+    os.makedirs(path.parent, exist_ok=True)
+    part_file = f"{path}.part"
+    with open(part_file, 'wb') as out:
+        out.write(zlib.compress(chunk, archive.DEFAULT_COMPRESS_LEVEL))
+    os.replace(part_file, path)
+
+def store_file(backup_dir: str, file_name: str, workers: Optional[int] = None) -> StoreStats:
+    """
+    Move a backup file into the job's chunk store, leaving a small manifest
+    named '{file_name}.manifest' in its place.
+
+    Gzip files are chunked on their decompressed content, since a small change
+    in the input shifts every compressed byte after it. New chunks are
+    compressed on 'workers' threads (default: all cores).
+
+    Returns the store stats. Raises on failure, leaving the backup file as is.
+    """
+    backup_dir = Path(backup_dir)
+    source = backup_dir / file_name
+    store_dir = backup_dir / STORE_DIR_NAME
+    is_gzip = _is_gzip(source)
+    stats = StoreStats()
+    whole_hash = hashlib.sha256()
+    chunks = []
+    written = set()
+    workers = max(1, workers or os.cpu_count() or 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # zlib releases the GIL; at most workers * 2 chunks are held in memory
+        in_flight = deque()
+        with (gzip.open(source, 'rb') if is_gzip else open(source, 'rb')) as f:
+            for chunk in iter_chunks(f):
+                digest = hashlib.sha256(chunk).hexdigest()
+                whole_hash.update(chunk)
+                chunks.append([digest, len(chunk)])
+                stats.chunks += 1
+                stats.bytes_in += len(chunk)
+
+                path = _chunk_path(store_dir, digest)
+                if digest in written or path.exists():
+                    continue
+
+                written.add(digest)
+                in_flight.append(executor.submit(_write_chunk, path, chunk))
+                stats.new_chunks += 1
+                stats.new_bytes += len(chunk)
+                if len(in_flight) >= workers * 2:
+                    in_flight.popleft().result()
+
+        for future in in_flight:
+            future.result()
+
+    manifest = {
+        'file': file_name,
+        'gzip': is_gzip,
+        'size': stats.bytes_in,
+        'sha256': whole_hash.hexdigest(),
+        'chunks': chunks,
+    }
+    manifest_path = backup_dir / f"{file_name}{MANIFEST_SUFFIX}"
+    part_file = f"{manifest_path}.part"
+    with open(part_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(part_file, manifest_path)
+
+    os.remove(source)
+    return stats
+
+def restore_file(backup_dir: str, manifest_name: str, output_file: str) -> None:
+    """
+    Rebuild a stored backup file from its manifest. Gzip files come back as
+    gzip with the same content (though not byte for byte the same file).
+    """
+    backup_dir = Path(backup_dir)
+    store_dir = backup_dir / STORE_DIR_NAME
+    with open(backup_dir / manifest_name, 'r') as f:
+        manifest = json.load(f)
+
+    whole_hash = hashlib.sha256()
+    part_file = f"{output_file}.part"
+    try:
+        with open(part_file, 'wb') as raw:
+            writer = archive.ParallelGzipWriter(raw) if manifest['gzip'] else raw
+            try:
+                for digest, size in manifest['chunks']:
+                    with open(_chunk_path(store_dir, digest), 'rb') as f:
+                        chunk = zlib.decompress(f.read())
+                    if len(chunk) != size:
+                        raise ValueError(f"Chunk {digest} is corrupt.")
+                    whole_hash.update(chunk)
+                    writer.write(chunk)
+            finally:
+                if manifest['gzip']:
+                    writer.close()
+
+        if whole_hash.hexdigest() != manifest['sha256']:
+            raise ValueError(f"Restored content of {manifest_name} does not match its checksum.")
+        os.replace(part_file, output_file)
+    except BaseException:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+
+def _referenced_chunks(backup_dir: Path) -> Set[str]:
+    referenced = set()
+    for file_name in os.listdir(backup_dir):
+        if file_name.endswith(MANIFEST_SUFFIX):
+            # Any unreadable manifest raises, so nothing it references is collected.
+            with open(backup_dir / file_name, 'r') as f:
+                referenced.update(digest for digest, _ in json.load(f)['chunks'])
+    return referenced
+
+def collect_garbage(backup_dir: str) -> int:
+    """
+    Delete chunks no longer referenced by any manifest in backup_dir. Meant to
+    run right after retention pruning has removed old manifests.
+
+    Returns the number of chunks deleted.
+    """
+    backup_dir = Path(backup_dir)
+    store_dir = backup_dir / STORE_DIR_NAME
+    if not store_dir.is_dir():
+        return 0
+
+    referenced = _referenced_chunks(backup_dir)
+    deleted = 0
+    for dir_path, _, file_names in os.walk(store_dir):
+        for file_name in file_names:
+            # Leftover .part files from an interrupted run are never referenced.
+            if file_name not in referenced:
+                os.remove(Path(dir_path) / file_name)
+                deleted += 1
+    return deleted
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Restore a backup file from a backup-apps chunk store.")
+    parser.add_argument('backup_dir', help="The job's backup directory (e.g. /var/local/backups/caddy).")
+    parser.add_argument('manifest', help=f"Manifest file name in backup_dir (ends with '{MANIFEST_SUFFIX}').")
+    parser.add_argument('output_file', help="Where to write the restored backup file.")
+    args = parser.parse_args()
+
+    try:
+        restore_file(args.backup_dir, args.manifest, args.output_file)
+    except Exception as e:
+        print(f"Restore failed: {str(e)}")
+        return 1
+
+    print(f"Restored {args.manifest} to {args.output_file}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import os
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+import archive
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PROGRESS_INTERVAL = 5.0
+
+@dataclass
+class DumpStats:
+    bytes_in: int = 0
+    bytes_out: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes read from the command per second."""
+        return self.bytes_in / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.bytes_in} bytes in, {self.bytes_out} bytes out, {self.seconds:.1f}s, "
+                f"{self.throughput / (1024 * 1024):.1f} MiB/s")
+
+def print_progress(stats: DumpStats) -> None:
+    """Progress callback that prints the running totals."""
+    print(f"  ...{stats}")
+
+class _CountingWriter:
+    """Uncompressed pass-through writer with the same interface as ParallelGzipWriter."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data) -> int:
+        self._fileobj.write(data)
+        self.bytes_in += len(data)
+        self.bytes_out += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        pass
+
+def stream_command_to_file(cmd: List[str], output_file: str, compress: bool = True,
+                           level: int = archive.DEFAULT_COMPRESS_LEVEL, workers: Optional[int] = None,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           progress: Optional[Callable[[DumpStats], None]] = None,
+                           progress_interval: float = DEFAULT_PROGRESS_INTERVAL) -> DumpStats:
+    """
+    Run a command and stream its stdout to output_file in bounded memory,
+    optionally gzip compressing it on multiple cores.
+
+    Chunks are written as they arrive. The file is written next to its final
+    name and renamed into place once the command succeeds.
+
+    Returns the dump stats. Raises on failure.
+    """
+    stats = DumpStats()
+    start_time = time.perf_counter()
+    last_progress = start_time
+    part_file = f"{output_file}.part"
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # Drain stderr on its own thread so a chatty command can't block on a full pipe.
+    stderr_chunks = []
+    stderr_thread = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+    stderr_thread.start()
+
+    try:
+        with open(part_file, 'wb') as raw:
+            writer = archive.ParallelGzipWriter(raw, level=level, workers=workers) if compress else _CountingWriter(raw)
+            try:
+                while True:
+                    chunk = proc.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+
+                    now = time.perf_counter()
+                    if progress and now - last_progress >= progress_interval:
+                        stats.bytes_in = writer.bytes_in
+                        stats.bytes_out = writer.bytes_out
+                        stats.seconds = now - start_time
+                        progress(stats)
+                        last_progress = now
+            finally:
+                writer.close()
+            stats.bytes_in = writer.bytes_in
+            stats.bytes_out = writer.bytes_out
+
+        return_code = proc.wait()
+        stderr_thread.join()
+        stderr = b"".join(stderr_chunks).decode('utf-8', errors='replace').strip()
+
+        if return_code != 0:
+            raise Exception(f"Command failed {return_code}: {stderr}")
+        if stats.bytes_in == 0:
+            raise Exception("No output from command.")
+
+        os.replace(part_file, output_file)
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+
+    stats.seconds = time.perf_counter() - start_time
+    if progress:
+        progress(stats)
+    return stats
+
+def dump_container(container_name: str, command: List[str], output_file: str, **kwargs) -> DumpStats:
+    """
+    Stream the output of a command run inside a container (e.g. pg_dump) to output_file.
+
+    No TTY is allocated, so the dump's bytes reach the file unaltered.
+    Keyword arguments are passed on to stream_command_to_file.
+    """
+    return stream_command_to_file(['docker', 'exec', container_name, *command], output_file, **kwargs)
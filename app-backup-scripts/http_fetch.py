@@ -0,0 +1,65 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_POOL_SIZE = 10
+
+class HttpFetchError(Exception):
+    pass
+
+def create_session(verify: bool = True, pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Create a keep-alive session with a connection pool, meant to be shared by
+    every request a handler makes during one run.
+    """
+    session = requests.Session()
+    session.verify = verify
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def download_to_file(session: requests.Session, method: str, url: str, output_file: str,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs) -> int:
+    """
+    Stream the response body of a request to output_file in bounded memory.
+
+    The body is written to a .part file, checked against Content-Length when
+    the server sends one, then renamed into place. Keyword arguments are passed
+    on to session.request (headers, json, timeout, ...).
+
+    Returns the number of bytes written. Raises HttpFetchError on a non 200
+    response or a truncated body.
+    """
+    part_file = f"{output_file}.part"
+
+    with session.request(method, url, stream=True, **kwargs) as response:
+        if response.status_code != 200:
+            raise HttpFetchError(f"HTTP {response.status_code} - {response.text}")
+
+        # With a Content-Encoding, requests decodes the body, so the size on disk
+        # won't match the header. Compare against the bytes read off the wire.
+        content_length = response.headers.get('Content-Length', None)
+        encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+
+        bytes_written = 0
+        try:
+            with open(part_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    bytes_written += len(chunk)
+
+            if content_length is not None:
+                received = response.raw.tell() if encoded else bytes_written
+                if received != int(content_length):
+                    raise HttpFetchError(f"Incomplete download from {url}: "
+                                         f"received {received} of {content_length} bytes")
+
+            os.replace(part_file, output_file)
+        except BaseException:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            raise
+
+    return bytes_written
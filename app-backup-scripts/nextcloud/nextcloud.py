@@ -1,4 +1,4 @@
-import subprocess
+import archive
 from typing import Dict, Any, Tuple
 
 class Handler:
@@ -26,15 +26,13 @@ class Handler:
 
             tar_file_full_name = f"{backup_dir}/{tar_file}"
 
-            proc = subprocess.run(
-                ["tar", "-czf", tar_file_full_name, "-C", tar_dir, "./"],
-                capture_output=True,
-                text=True
+            stats = archive.create_archive(
+                tar_file_full_name,
+                tar_dir,
+                level=vars_dict.get('tar_compress_level', archive.DEFAULT_COMPRESS_LEVEL),
+                workers=vars_dict.get('tar_compress_workers', None)
             )
 
-            if proc.returncode != 0:
-                return False, f"Tar command failed: {proc.stderr.strip()}"
-
-            return True, f"Successfully created backup: {tar_file_full_name}."
+            return True, f"Successfully created backup: {tar_file_full_name} ({stats})."
         except Exception as e:
             return False, f"Exception occurred: {str(e)}"
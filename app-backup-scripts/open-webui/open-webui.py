@@ -1,47 +1,21 @@
+import archive
+import container_dump
 import subprocess
 from typing import Dict, Any, Tuple
 
 class Handler:
-    def _dump_litellm_database(self, temp_dir: str, container_name: str) -> None:
+    def _dump_litellm_database(self, temp_dir: str, container_name: str, level: int) -> None:
         print("Dumping LiteLLM database...")
 
-        docker_process = subprocess.Popen([
-            'docker', 'exec', '-t', container_name, 'pg_dump', '-c',
-            '-U', 'llmproxy', '-d', 'litellm'
-        ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+        stats = container_dump.dump_container(
+            container_name,
+            ['pg_dump', '-c', '-U', 'llmproxy', '-d', 'litellm'],
+            f"{temp_dir}/litellm-db.sql.gz",
+            level=level,
+            progress=container_dump.print_progress
         )
 
-        gzip_process = subprocess.Popen([
-            'gzip'
-        ],
-            stdin=docker_process.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-
-        # Allow docker_process to receive a SIGPIPE if gzip_process exits.
-        docker_process.stdout.close() 
-
-        # Get the compressed output
-        compressed_output, gzip_err = gzip_process.communicate()
-
-        # Wait for docker process to finish
-        docker_err = docker_process.stderr.read()
-        docker_return_code = docker_process.wait()
-
-        if docker_return_code != 0:
-            raise Exception(f"Database dump failed {docker_return_code}: {docker_err.decode('utf-8')}")
-        if gzip_process.returncode != 0:
-            raise Exception(f"Gzip process failed {gzip_process.returncode}: {gzip_err.decode('utf-8')}")
-        if not compressed_output:
-            raise Exception("No output from gzip process.")
-
-        with open(f"{temp_dir}/litellm-db.sql.gz", 'wb') as f:
-            f.write(compressed_output)
-
-        print("Database dump completed successfully.")
+        print(f"Database dump completed successfully ({stats}).")
 
     def _dump_openwebui_files(self, temp_dir: str, container_name: str) -> None:
         print("Dumping Open-WebUI files...")
@@ -57,21 +31,15 @@ class Handler:
 
         print("Open-WebUI files dumped successfully.")
 
-    def _make_tar_file(self, backup_dir: str, tar_dir: str, tar_file: str) -> None:
+    def _make_tar_file(self, backup_dir: str, tar_dir: str, tar_file: str, level: int) -> archive.ArchiveStats:
         print("Creating final tar file...")
 
         tar_file_full_name = f"{backup_dir}/{tar_file}"
 
-        proc = subprocess.run(
-            ["tar", "-czf", tar_file_full_name, "-C", tar_dir, "./"],
-            capture_output=True,
-            text=True
-        )
-
-        if proc.returncode != 0:
-            raise Exception(f"Tar command failed: {proc.stderr.strip()}")
+        stats = archive.create_archive(tar_file_full_name, tar_dir, level=level)
 
-        print (f"Successfully created backup: {tar_file_full_name}.")
+        print (f"Successfully created backup: {tar_file_full_name} ({stats}).")
+        return stats
 
     def run(self, vars_dict: Dict[str, Any]) -> Tuple[bool, str]:
         """
@@ -83,6 +51,7 @@ class Handler:
             backup_dir = vars_dict.get('backup_dir', None)
             temp_dir = vars_dict.get('temp_dir', None)
             tar_file = vars_dict.get('tar_file', None)
+            tar_compress_level = vars_dict.get('tar_compress_level', archive.DEFAULT_COMPRESS_LEVEL)
             container_names = vars_dict.get('container_names', {})
             db_container_name = container_names.get('litellm_db', None)
             openwebui_container_name = container_names.get('open_webui', None)
@@ -101,10 +70,10 @@ class Handler:
             if not openwebui_container_name:
                 return False, "'open_webui' not defined in config."
 
-            self._dump_litellm_database(temp_dir, db_container_name)
+            self._dump_litellm_database(temp_dir, db_container_name, tar_compress_level)
             self._dump_openwebui_files(temp_dir, openwebui_container_name)
-            self._make_tar_file(backup_dir, temp_dir, tar_file)
+            stats = self._make_tar_file(backup_dir, temp_dir, tar_file, tar_compress_level)
 
-            return True, f"Successfully created backup."
+            return True, f"Successfully created backup ({stats})."
         except Exception as e:
             return False, f"Exception occurred: {str(e)}"
\ No newline at end of file
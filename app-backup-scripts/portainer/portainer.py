@@ -1,12 +1,13 @@
+import http_fetch
 import requests
 from typing import Dict, Any, Tuple
 
 class Handler:
-    def _get_backup(self, api_url_root: str, password: str, jwt: str) -> Tuple[bytes, str]:
+    def _get_backup(self, session: requests.Session, api_url_root: str, password: str, jwt: str, tar_path: str) -> Tuple[int, str]:
         """
-        Request backup from Portainer API.
+        Request backup from Portainer API and stream it to tar_path.
         
-        Returns a tuple of (backup_data, message).
+        Returns a tuple of (bytes_written, message).
         """
         try:
             print("Requesting backup from Portainer API...")
@@ -20,18 +21,18 @@ class Handler:
             }
             url = f"{api_url_root}/backup"
 
-            response = requests.post(url, headers=headers, json=post_data, timeout=600, verify=False)
-
-            if response.status_code != 200:
-                return None, f"Failed to get backup: HTTP {response.status_code} - {response.text}"
+            bytes_written = http_fetch.download_to_file(session, 'POST', url, tar_path,
+                                                        headers=headers, json=post_data, timeout=600)
 
             print("Backup obtained successfully.")
-            return response.content, None
+            return bytes_written, None
 
+        except http_fetch.HttpFetchError as e:
+            return None, f"Failed to get backup: {str(e)}"
         except Exception as e:
             return None, f"Exception occurred while obtaining backup: {str(e)}"
 
-    def _get_jwt_token(self, api_url_root: str, username: str, password: str) -> Tuple[str, str]:
+    def _get_jwt_token(self, session: requests.Session, api_url_root: str, username: str, password: str) -> Tuple[str, str]:
         """
         Obtain JWT token from Portainer API.
         
@@ -46,7 +47,7 @@ class Handler:
             }
             url = f"{api_url_root}/auth"
 
-            response = requests.post(url, json=post_data, timeout=30, verify=False)
+            response = session.post(url, json=post_data, timeout=30)
 
             if response.status_code != 200:
                 return None, f"Failed to get JWT token: HTTP {response.status_code} - {response.text}"
@@ -89,20 +90,20 @@ class Handler:
             if not password:
                 return False, "'password' not defined."
 
-            jwt, fail_message = self._get_jwt_token(api_url_root, username, password)
-            if fail_message:
-                return False, fail_message
+            tar_path = f"{backup_dir}/{tar_file}"
 
-            backup_data, fail_message = self._get_backup(api_url_root, password, jwt)
-            if fail_message:
-                return False, fail_message
+            # One session for the run, so auth and backup share a TLS connection.
+            with http_fetch.create_session(verify=False) as session:
+                jwt, fail_message = self._get_jwt_token(session, api_url_root, username, password)
+                if fail_message:
+                    return False, fail_message
 
-            tar_path = f"{backup_dir}/{tar_file}"
-            with open(tar_path, 'wb') as f:
-                f.write(backup_data)
+                bytes_written, fail_message = self._get_backup(session, api_url_root, password, jwt, tar_path)
+                if fail_message:
+                    return False, fail_message
 
             print(f"Backup saved to {tar_path}.")
-            return True, f"Backup createdd successfully."
+            return True, f"Backup created successfully ({bytes_written} bytes)."
 
         except Exception as e:
             return False, f"Exception occurred during backup process: {str(e)}"
@@ -1,11 +1,183 @@
-import subprocess
-from typing import Dict, Any, Tuple
+import archive
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+# Incremental mode state lives in a subdirectory so it isn't counted (or
+# pruned) as a backup file.
+INDEX_DIR_NAME = ".incremental"
+INDEX_FILE_NAME = "index.json"
+CHAIN_FILE_NAME = "chain.json"
+DEFAULT_FULL_BACKUP_EVERY = 7
+
+def _load_json(path: Path, default: Any) -> Any:
+    if not path.exists():
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _save_json(path: Path, data: Any) -> None:
+    part_file = f"{path}.part"
+    with open(part_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(part_file, path)
+
+def _hash_file(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def restore(backup_dir: str, target_dir: str, backup_date: Optional[str] = None) -> List[str]:
+    """
+    Rebuild the state of an incremental backup job as of backup_date (yymmdd,
+    default latest) into target_dir.
+
+    Extracts the newest full backup at or before that date, then replays each
+    incremental after it, removing the paths it recorded as deleted.
+
+    Returns the backup files applied, in order.
+    """
+    chain = _load_json(Path(backup_dir) / INDEX_DIR_NAME / CHAIN_FILE_NAME, [])
+    entries = [e for e in chain if backup_date is None or e['date'] <= backup_date]
+    fulls = [i for i, e in enumerate(entries) if e['type'] == 'full']
+    if not fulls:
+        raise ValueError(f"No full backup found in {backup_dir} at or before {backup_date or 'latest'}.")
+
+    # Python 3.12+ warns without an explicit extraction filter.
+    extract_kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+
+    os.makedirs(target_dir, exist_ok=True)
+    applied = []
+    for entry in entries[fulls[-1]:]:
+        for rel_path in entry['deleted']:
+            path = Path(target_dir) / rel_path
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        with tarfile.open(Path(backup_dir) / entry['file'], 'r:gz') as tar:
+            tar.extractall(target_dir, **extract_kwargs)
+        applied.append(entry['file'])
+
+    return applied
 
 class Handler:
+    def _run_incremental(self, vars_dict: Dict[str, Any], tar_file_full_name: str) -> Tuple[bool, str]:
+        """
+        Backup only what changed since the previous backup of this job.
+
+        A per-job index of path -> [mtime_ns, size, sha256] decides what changed.
+        Files whose mtime and size match the index aren't read at all. A full
+        backup is made every 'full_backup_every' backups.
+        """
+        backup_dir = Path(vars_dict['backup_dir'])
+        tar_file = vars_dict['tar_file']
+        backup_date = vars_dict.get('backup_date', '')
+        full_backup_every = max(1, int(vars_dict.get('full_backup_every', DEFAULT_FULL_BACKUP_EVERY)))
+
+        index_dir = backup_dir / INDEX_DIR_NAME
+        os.makedirs(index_dir, exist_ok=True)
+        chain = _load_json(index_dir / CHAIN_FILE_NAME, [])
+        old_index = _load_json(index_dir / INDEX_FILE_NAME, {})
+
+        # A rerun on the same day replaces that day's backup. The index already
+        # includes it, so only a full backup is safe.
+        rerun = bool(chain) and chain[-1]['file'] == tar_file
+        if rerun:
+            chain.pop()
+
+        fulls = [i for i, e in enumerate(chain) if e['type'] == 'full']
+        is_full = (rerun
+                   or not fulls
+                   or len(chain) - fulls[-1] >= full_backup_every
+                   or not all((backup_dir / e['file']).exists() for e in chain[fulls[-1]:]))
+
+        new_index = {}
+
+        def select(full_path: Path, tarinfo: tarfile.TarInfo) -> bool:
+            st = os.lstat(full_path)
+            old = old_index.get(tarinfo.name, None)
+            if tarinfo.isreg():
+                if old and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+                    digest = old[2]
+                else:
+                    digest = _hash_file(full_path)
+            elif tarinfo.isdir():
+                digest = "dir"
+            else:
+                digest = f"link:{tarinfo.linkname}"
+
+            new_index[tarinfo.name] = [st.st_mtime_ns, st.st_size, digest]
+            # Directories are always written so empty ones restore too.
+            return is_full or tarinfo.isdir() or not old or old[2] != digest
+
+        stats = archive.create_archive(
+            tar_file_full_name,
+            vars_dict['tar_dir'],
+            exclude=vars_dict.get('tar_exclude', []),
+            level=vars_dict.get('tar_compress_level', archive.DEFAULT_COMPRESS_LEVEL),
+            workers=vars_dict.get('tar_compress_workers', None),
+            select=select
+        )
+
+        deleted = [] if is_full else sorted(set(old_index) - set(new_index))
+        backup_type = 'full' if is_full else 'incremental'
+        chain.append({'file': tar_file, 'date': backup_date, 'type': backup_type, 'deleted': deleted})
+
+        # Index last: if writing the chain fails, the next run still diffs against the old index.
+        _save_json(index_dir / CHAIN_FILE_NAME, chain)
+        _save_json(index_dir / INDEX_FILE_NAME, new_index)
+
+        return True, f"Successfully created {backup_type} backup: {tar_file_full_name} ({stats}, {len(deleted)} deleted)."
+
+    def prune_backups(self, backup_dir: Path, keep: int, vars_dict: Dict[str, Any]) -> bool:
+        """
+        Prune an incremental chain without orphaning incrementals: backups are
+        only removed up to the full backup the oldest kept one depends on.
+        Backup files not in the chain (made before incremental mode was turned
+        on) are removed once the chain alone holds 'keep' backups.
+
+        Returns False in non-incremental mode so the default pruning applies.
+        """
+        if not vars_dict.get('incremental', False):
+            return False
+
+        index_dir = Path(backup_dir) / INDEX_DIR_NAME
+        chain = _load_json(index_dir / CHAIN_FILE_NAME, [])
+
+        cut = len(chain) - keep
+        fulls = [i for i, e in enumerate(chain) if e['type'] == 'full' and i <= cut]
+        start = fulls[-1] if cut > 0 and fulls else 0
+
+        to_delete = [e['file'] for e in chain[:start]]
+        if len(chain) >= keep:
+            chain_files = {e['file'] for e in chain}
+            to_delete.extend(f for f in os.listdir(backup_dir)
+                             if f not in chain_files and os.path.isfile(Path(backup_dir) / f))
+
+        for file_name in to_delete:
+            file_path = Path(backup_dir) / file_name
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+        if start > 0:
+            _save_json(index_dir / CHAIN_FILE_NAME, chain[start:])
+
+        return True
+
     def run(self, vars_dict: Dict[str, Any]) -> Tuple[bool, str]:
         """
         Backup directory using tar command with given variables.
-        
+
         Returns a tuple indicating success and a message.
         """
         try:
@@ -26,21 +198,39 @@ class Handler:
 
             tar_file_full_name = f"{backup_dir}/{tar_file}"
 
-            # Build tar command with exclusions
-            cmd = ["tar", "-czf", tar_file_full_name]
-            for exclude in tar_exclude:
-                cmd.extend(["--exclude", exclude])
-            cmd.extend(["-C", tar_dir, "./"])
+            if vars_dict.get('incremental', False):
+                return self._run_incremental(vars_dict, tar_file_full_name)
 
-            proc = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True
+            stats = archive.create_archive(
+                tar_file_full_name,
+                tar_dir,
+                exclude=tar_exclude,
+                level=vars_dict.get('tar_compress_level', archive.DEFAULT_COMPRESS_LEVEL),
+                workers=vars_dict.get('tar_compress_workers', None)
             )
 
-            if proc.returncode != 0:
-                return False, f"Tar command failed: {proc.stderr.strip()}"
-
-            return True, f"Successfully created backup: {tar_file_full_name}."
+            return True, f"Successfully created backup: {tar_file_full_name} ({stats})."
         except Exception as e:
             return False, f"Exception occurred: {str(e)}"
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Restore a backup made by the tar handler in incremental mode.")
+    parser.add_argument('backup_dir', help="The job's backup directory (e.g. /var/local/backups/caddy).")
+    parser.add_argument('target_dir', help="Directory to restore into.")
+    parser.add_argument('-d', '--date', dest='backup_date', metavar='YYMMDD',
+                        help="Restore the state as of this backup date (default: latest).")
+    args = parser.parse_args()
+
+    try:
+        applied = restore(args.backup_dir, args.target_dir, args.backup_date)
+    except Exception as e:
+        print(f"Restore failed: {str(e)}")
+        return 1
+
+    for file_name in applied:
+        print(f"Applied {file_name}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
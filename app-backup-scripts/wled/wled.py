@@ -1,12 +1,18 @@
+import archive
+import http_fetch
+import os
 import requests
-import subprocess
-from typing import Dict, Any, Tuple
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
 
 class Handler:
     _config_file_name = "cfg.json"
     _presets_file_name = "presets.json"
+    _default_timeout = 30
+    _default_max_parallel_fetches = 8
 
-    def _backup_file(self, controller_ip: str, file_name: str, temp_dir: str) -> None:
+    def _backup_file(self, session: requests.Session, controller_ip: str, file_name: str, temp_dir: str, timeout: int) -> None:
         """
         Backup configuration file from WLED controller.
         """
@@ -14,43 +20,90 @@ class Handler:
 
         url = f"http://{controller_ip}/{file_name}"
 
-        response = requests.get(url, timeout=30)
+        try:
+            http_fetch.download_to_file(session, 'GET', url, f"{temp_dir}/{file_name}", timeout=timeout)
+        except http_fetch.HttpFetchError as e:
+            raise Exception(f"Failed to get {file_name}: {str(e)}")
 
-        if response.status_code != 200:
-            raise Exception(f"Failed to get {file_name}: HTTP {response.status_code} - {response.text}")
+        print(f"Successfully backed up {file_name} to {temp_dir}/{file_name}.")
 
-        with open(f"{temp_dir}/{file_name}", 'wb') as f:
-            f.write(response.content)
+    def _backup_controller(self, controller: Dict[str, Any], temp_dir: str) -> Tuple[bool, str]:
+        """
+        Backup all files of one WLED controller into its own directory, reusing
+        one keep-alive session for the controller.
 
-        print(f"Successfully backed up {file_name} to {temp_dir}/{file_name}.")
+        Returns a tuple indicating success and a message.
+        """
+        controller_ip = controller['ip']
+        controller_dir = f"{temp_dir}/{controller['name']}" if controller['name'] else temp_dir
 
-    def _make_tar_file(self, backup_dir: str, tar_dir: str, tar_file: str) -> None:
+        try:
+            os.makedirs(controller_dir, exist_ok=True)
+            with http_fetch.create_session(pool_size=1) as session:
+                self._backup_file(session, controller_ip, self._config_file_name, controller_dir, controller['timeout'])
+                self._backup_file(session, controller_ip, self._presets_file_name, controller_dir, controller['timeout'])
+            return True, controller_ip
+        except Exception as e:
+            # Leave nothing half backed up in the archive.
+            if controller['name']:
+                shutil.rmtree(controller_dir, ignore_errors=True)
+            return False, f"{controller_ip}: {str(e)}"
+
+    def _get_controllers(self, vars_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Normalize the configured controllers into a list of {name, ip, timeout}.
+
+        'controllers' entries may be an IP string or a dict with 'ip' and optional
+        'name' and 'timeout'. Each is placed in a directory named after the
+        controller. A lone 'controller_ip' keeps the original flat layout.
+        """
+        default_timeout = vars_dict.get('timeout', self._default_timeout)
+        controllers = []
+
+        for entry in vars_dict.get('controllers', []) or []:
+            if isinstance(entry, str):
+                entry = {'ip': entry}
+            ip = entry.get('ip', None)
+            if not ip:
+                raise ValueError(f"Controller entry missing 'ip': {entry}")
+            controllers.append({
+                'ip': ip,
+                'name': str(entry.get('name', ip)).replace(':', '_').replace('/', '_'),
+                'timeout': entry.get('timeout', default_timeout),
+            })
+
+        controller_ip = vars_dict.get('controller_ip', None)
+        if controller_ip:
+            controllers.append({
+                'ip': controller_ip,
+                'name': controller_ip.replace(':', '_') if controllers else None,
+                'timeout': default_timeout,
+            })
+
+        return controllers
+
+    def _make_tar_file(self, backup_dir: str, tar_dir: str, tar_file: str, level: int) -> archive.ArchiveStats:
         print("Creating final tar file...")
 
         tar_file_full_name = f"{backup_dir}/{tar_file}"
 
-        proc = subprocess.run(
-            ["tar", "-czf", tar_file_full_name, "-C", tar_dir, "./"],
-            capture_output=True,
-            text=True
-        )
+        stats = archive.create_archive(tar_file_full_name, tar_dir, level=level)
 
-        if proc.returncode != 0:
-            raise Exception(f"Tar command failed: {proc.stderr.strip()}")
-
-        print (f"Successfully created backup: {tar_file_full_name}.")
+        print (f"Successfully created backup: {tar_file_full_name} ({stats}).")
+        return stats
 
     def run(self, vars_dict: Dict[str, Any]) -> Tuple[bool, str]:
         """
         Process WLED backup with given variables.
-        
+
         Returns a tuple indicating success and a message.
         """
         try:
             backup_dir = vars_dict.get('backup_dir', None)
             temp_dir = vars_dict.get('temp_dir', None)
             tar_file = vars_dict.get('tar_file', None)
-            controller_ip = vars_dict.get('controller_ip', None)
+            tar_compress_level = vars_dict.get('tar_compress_level', archive.DEFAULT_COMPRESS_LEVEL)
+            max_parallel_fetches = vars_dict.get('max_parallel_fetches', self._default_max_parallel_fetches)
 
             # From caller
             if not backup_dir:
@@ -61,15 +114,23 @@ class Handler:
                 return False, "temp_dir not defined."
 
             # From config.yml
-            if not controller_ip:
-                return False, "'controller_ip' not defined."
+            controllers = self._get_controllers(vars_dict)
+            if not controllers:
+                return False, "'controllers' or 'controller_ip' not defined."
+
+            with ThreadPoolExecutor(max_workers=max(1, min(max_parallel_fetches, len(controllers)))) as executor:
+                results = list(executor.map(lambda c: self._backup_controller(c, temp_dir), controllers))
 
-            self._backup_file(controller_ip, self._config_file_name, temp_dir)
-            self._backup_file(controller_ip, self._presets_file_name, temp_dir)
+            failures = [message for success, message in results if not success]
+            if len(failures) == len(controllers):
+                return False, f"No controllers could be backed up: {'; '.join(failures)}"
 
-            self._make_tar_file(backup_dir, temp_dir, tar_file)
+            stats = self._make_tar_file(backup_dir, temp_dir, tar_file, tar_compress_level)
 
-            return True, f"Backup created successfully."
+            message = f"Backup created successfully for {len(controllers) - len(failures)} of {len(controllers)} controllers ({stats})."
+            if failures:
+                message += f" Unreachable: {'; '.join(failures)}"
+            return True, message
 
         except Exception as e:
             return False, f"Exception occurred during backup process: {str(e)}"
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import itertools
 import json
 import os
 import re
 import shutil
 import subprocess
+import time
 import unicodedata
 
 _SCRIPT_DESCRIPTION = """
@@ -15,9 +18,23 @@ based on chapters.
 
 _SCRIPT_EPILOG = """
 Chapters are determined based on makers from m4b file. MP3 files will be placed
-in a subdirectory where the input file is located.
+in a subdirectory where the input file is located. With --library, INPUT_FILE is
+a directory that is searched for m4b files. Finished chapters are recorded in a
+work queue in that directory, so an interrupted run picks up where it left off.
+When a directory holds more than one m4b file, each book's mp3 files go to
+mp3/<book file name> instead of mp3.
+Author and title are taken from each book's tags, falling back to the
+Author/Title/book.m4b directory layout. Probe results are cached in the library
+directory by path, size and modification time, so only new or changed books are
+probed again. --plan reports the chapters left and an estimated encode time
+without encoding anything; the estimate uses the speed measured by earlier runs.
 """
 
+_QUEUE_FILE_NAME = ".m4b-to-mp3-queue.jsonl"
+_PROBE_CACHE_FILE_NAME = ".m4b-to-mp3-probe-cache.json"
+# audio seconds encoded per second by one job, until a run has measured it
+_DEFAULT_ENCODE_SPEED = 30.0
+
 class Chapter():
 
     def __init__(self, raw_obj):
@@ -45,20 +62,27 @@ class Chapter():
         temp_value = re.sub(r"[-\s]+", "-", temp_value).strip("-_")
         self.file_name = f"{temp_value}.mp3"
 
-def get_chapters(input_file):
+def probe_input(input_file):
     ret = subprocess.run(
         [
             "ffprobe",
             "-i", input_file,
             "-print_format", "json",
-            "-show_chapters"
+            "-show_chapters",
+            "-show_format",
+            "-show_streams",
+            "-select_streams", "a"
         ],
-        stdout=subprocess.PIPE
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
     )
 
     ret.check_returncode()
 
-    j = json.loads(ret.stdout.decode('utf-8'))
+    return json.loads(ret.stdout.decode('utf-8'))
+
+def get_chapters(input_file, probe=None):
+    j = probe if probe is not None else probe_input(input_file)
     #print(j)
     chapters = []
     for raw_chapter in j["chapters"]:
@@ -70,7 +94,15 @@ def get_chapters(input_file):
 
     return chapters
 
-def create_output_directory(input_file):
+def get_book_tags(input_file, probe):
+    # Prefer the file's own tags, then fall back to an Author/Title/book.m4b layout.
+    tags = {k.lower(): v for k, v in probe.get("format", {}).get("tags", {}).items()}
+    book_dir = os.path.dirname(os.path.abspath(input_file))
+    author = tags.get("artist") or tags.get("album_artist") or os.path.basename(os.path.dirname(book_dir))
+    book_title = tags.get("album") or tags.get("title") or os.path.basename(book_dir)
+    return author, book_title
+
+def get_output_directory(input_file, per_book=False):
     # we will create a subdirectory in the same directory as the input file.
     parent_dir = os.path.dirname(input_file)
     # print(f"Parent Directory={parent_dir}")
@@ -78,49 +110,389 @@ def create_output_directory(input_file):
     out_dir = os.path.join(parent_dir, "mp3")
     # print(f"Output dir={out_dir}")
 
+    # in a library, books sharing a directory each get their own subdirectory
+    if per_book:
+        siblings = [f for f in os.listdir(parent_dir or ".") if f.lower().endswith(".m4b")]
+        if len(siblings) > 1:
+            out_dir = os.path.join(out_dir, os.path.splitext(os.path.basename(input_file))[0])
+
+    return out_dir
+
+def create_output_directory(input_file):
+    out_dir = get_output_directory(input_file)
+
     if os.path.isdir(out_dir):
         shutil.rmtree(out_dir)
     os.makedirs(out_dir)
 
     return out_dir
 
-def split_input_into_chapters(input_file, author, book_title, chapters):
+def encode_chapter(input_file, out_dir, author, book_title, chapter):
+    # -ss/-t before -i seek the input, so ffmpeg only decodes this chapter's
+    # span instead of decoding (and discarding) everything before it.
+    # -y overwrites the .part file an interrupted run may have left behind;
+    # -nostdin keeps parallel encoders off the terminal.
+    duration = float(chapter.end_time) - float(chapter.start_time)
+    out_file = os.path.join(out_dir, chapter.file_name)
+    ret = subprocess.run(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-y",
+            "-ss", chapter.start_time,
+            "-t", f"{duration:.6f}",
+            "-i", input_file,
+            "-vn", "-c", "libmp3lame",
+            "-metadata", f"title={chapter.metadata_title}",
+            "-metadata", f"track={chapter.track}",
+            "-metadata", f"artist={author}",
+            "-metadata", f"album={book_title}",
+            "-map_metadata", "0",
+            "-id3v2_version", "3",
+            "-f", "mp3",
+            f"{out_file}.part"
+        ],
+        stderr=subprocess.DEVNULL
+    )
+
+    ret.check_returncode()
+
+    # only a complete file ever gets the final name
+    os.replace(f"{out_file}.part", out_file)
+
+    return chapter
+
+def split_input_into_chapters(input_file, author, book_title, chapters, jobs=1):
+    out_dir = create_output_directory(input_file)
+    count_chapters = len(chapters)
+    print(f"Creating {count_chapters} chapters with {jobs} jobs")
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # map yields results in chapter order, so progress is reported in order
+        # even when later chapters finish first.
+        results = executor.map(
+            lambda c: encode_chapter(input_file, out_dir, author, book_title, c),
+            chapters)
+        for idx, chapter in enumerate(results):
+            print(f"Done with chapter: {chapter.file_name} ({idx + 1}/{count_chapters})")
+
+
+def split_input_single_pass(input_file, author, book_title, chapters):
+    # Decode the input once and fan the audio out to one encoder per chapter:
+    # asplit copies the decoded stream, atrim keeps each chapter's span, and
+    # asetpts restarts each chapter's timestamps at zero.
+    if not chapters:
+        print("No chapters found, nothing to do")
+        return
+
     out_dir = create_output_directory(input_file)
     count_chapters = len(chapters)
+    print(f"Creating {count_chapters} chapters in a single pass")
+
+    labels = "".join(f"[s{idx}]" for idx in range(count_chapters))
+    graph = [f"[0:a]asplit={count_chapters}{labels}"] if count_chapters > 1 else ["[0:a]anull[s0]"]
     for idx, chapter in enumerate(chapters):
-        print(f"Creating chapter: {chapter.file_name} ({idx + 1}/{count_chapters})")
-        ret = subprocess.run(
-            [
-                "ffmpeg",
-                "-i", input_file,
-                "-vn", "-c", "libmp3lame",
-                "-ss", chapter.start_time,
-                "-to", chapter.end_time,
-                "-metadata", f"title={chapter.metadata_title}",
-                "-metadata", f"track={chapter.track}",
-                "-metadata", f"artist={author}",
-                "-metadata", f"album={book_title}",
-                "-map_metadata", "0",
-                "-id3v2_version", "3",
-                f"{os.path.join(out_dir, chapter.file_name)}"
-            ],
-            stderr=subprocess.DEVNULL
-        )
+        graph.append(
+            f"[s{idx}]atrim=start={chapter.start_time}:end={chapter.end_time},"
+            f"asetpts=PTS-STARTPTS[c{idx}]")
 
-        ret.check_returncode()
+    cmd = ["ffmpeg", "-nostdin", "-i", input_file, "-filter_complex", ";".join(graph)]
+    for idx, chapter in enumerate(chapters):
+        cmd.extend([
+            "-map", f"[c{idx}]",
+            "-c", "libmp3lame",
+            "-metadata", f"title={chapter.metadata_title}",
+            "-metadata", f"track={chapter.track}",
+            "-metadata", f"artist={author}",
+            "-metadata", f"album={book_title}",
+            "-map_metadata", "0",
+            "-id3v2_version", "3",
+            "-f", "mp3",
+            f"{os.path.join(out_dir, chapter.file_name)}.part"
+        ])
+
+    ret = subprocess.run(cmd, stderr=subprocess.DEVNULL)
 
-        print(F"Done with chapter: {chapter.file_name}")
+    ret.check_returncode()
 
+    # only complete files ever get their final names
+    for chapter in chapters:
+        out_file = os.path.join(out_dir, chapter.file_name)
+        os.replace(f"{out_file}.part", out_file)
+
+    print(f"Done with {count_chapters} chapters")
+
+
+class WorkQueue():
+    """
+    Persistent record of the (book, chapter) units of a library conversion.
+    A unit is done when it was recorded as done, its book hasn't changed since,
+    and its mp3 is still there with the recorded size.
+    """
+
+    def __init__(self, library_dir):
+        self.library_dir = library_dir
+        self.path = os.path.join(library_dir, _QUEUE_FILE_NAME)
+        self.units = {}
+        lines = 0
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        unit = json.loads(line)
+                    except ValueError:
+                        # a line torn by an interrupted run
+                        continue
+                    self.units[unit.pop("key")] = unit
+                    lines += 1
+
+        # the log is append-only; drop superseded lines once they pile up
+        if lines > 2 * len(self.units) + 100:
+            self._compact()
+        self._file = None
+
+    def key(self, book_file, chapter):
+        return f"{os.path.relpath(book_file, self.library_dir)}::{chapter.file_name}"
+
+    @staticmethod
+    def source_signature(book_file):
+        st = os.stat(book_file)
+        return [st.st_size, st.st_mtime_ns]
+
+    def is_done(self, key, source, out_file):
+        unit = self.units.get(key)
+        return (unit is not None
+                and unit["status"] == "done"
+                and unit["source"] == source
+                and os.path.isfile(out_file)
+                and os.path.getsize(out_file) == unit["size"])
+
+    def mark(self, key, source, status, out_file=None):
+        size = os.path.getsize(out_file) if out_file else 0
+        self.units[key] = {"status": status, "source": source, "size": size}
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps({"key": key, **self.units[key]}) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _compact(self):
+        with open(f"{self.path}.part", "w") as f:
+            for key, unit in self.units.items():
+                f.write(json.dumps({"key": key, **unit}) + "\n")
+        os.replace(f"{self.path}.part", self.path)
+
+class ProbeCache():
+    """
+    Persistent ffprobe results of a library, keyed by the book's path relative
+    to the library. An entry is only used while the book's size and
+    modification time match, so changed books are probed again.
+    """
+
+    def __init__(self, library_dir):
+        self.library_dir = library_dir
+        self.path = os.path.join(library_dir, _PROBE_CACHE_FILE_NAME)
+        self.books = {}
+        self.encode_speed = _DEFAULT_ENCODE_SPEED
+        self.misses = 0
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.books = data.get("books", {})
+            self.encode_speed = data.get("encode_speed", _DEFAULT_ENCODE_SPEED)
+
+    def get_probe(self, book_file):
+        key = os.path.relpath(book_file, self.library_dir)
+        source = WorkQueue.source_signature(book_file)
+        entry = self.books.get(key)
+        if entry is not None and entry["source"] == source:
+            return entry["probe"]
+
+        self.misses += 1
+        probe = probe_input(book_file)
+        # keep only what the splitter uses, the raw output can be large
+        probe = {
+            "chapters": [
+                {k: c[k] for k in ("id", "start_time", "end_time", "tags")}
+                for c in probe.get("chapters", [])
+            ],
+            "format": {k: v for k, v in probe.get("format", {}).items() if k in ("duration", "bit_rate", "tags")},
+            "streams": [
+                {k: v for k, v in s.items() if k in ("codec_name", "sample_rate", "channels", "bit_rate")}
+                for s in probe.get("streams", [])
+            ]
+        }
+        self.books[key] = {"source": source, "probe": probe}
+        return probe
+
+    def forget_missing(self, books):
+        present = {os.path.relpath(b, self.library_dir) for b in books}
+        self.books = {k: v for k, v in self.books.items() if k in present}
+
+    def save(self):
+        with open(f"{self.path}.part", "w") as f:
+            json.dump({"books": self.books, "encode_speed": self.encode_speed}, f)
+        os.replace(f"{self.path}.part", self.path)
+
+def format_duration(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def chapter_seconds(chapter):
+    return float(chapter.end_time) - float(chapter.start_time)
+
+def find_books(library_dir):
+    books = []
+    for dir_path, dir_names, file_names in os.walk(library_dir):
+        dir_names.sort()
+        books.extend(os.path.join(dir_path, f) for f in sorted(file_names) if f.lower().endswith(".m4b"))
+    return books
+
+def collect_library_units(library_dir, queue, cache):
+    """
+    Gather the chapters of every book in the library that still need encoding.
+
+    Returns the books, the pending units, the number of chapters already done
+    and the number of books that couldn't be read.
+    """
+    units = []
+    books = find_books(library_dir)
+    skipped = 0
+    failed = 0
+
+    for book in books:
+        try:
+            probe = cache.get_probe(book)
+            chapters = get_chapters(book, probe)
+        except Exception as e:
+            print(f"Skipping {book}: could not read chapters ({e})")
+            failed += 1
+            continue
+
+        author, book_title = get_book_tags(book, probe)
+        out_dir = get_output_directory(book, per_book=True)
+        source = WorkQueue.source_signature(book)
+
+        for chapter in chapters:
+            key = queue.key(book, chapter)
+            if queue.is_done(key, source, os.path.join(out_dir, chapter.file_name)):
+                skipped += 1
+                continue
+            units.append((book, out_dir, author, book_title, chapter, key, source))
+
+    cache.forget_missing(books)
+    cache.save()
+
+    return books, units, skipped, failed
+
+def plan_library(library_dir, jobs=1):
+    queue = WorkQueue(library_dir)
+    cache = ProbeCache(library_dir)
+    books, units, skipped, failed = collect_library_units(library_dir, queue, cache)
+
+    seconds = sum(chapter_seconds(unit[4]) for unit in units)
+    workers = max(1, min(jobs, len(units)))
+    estimate = seconds / (cache.encode_speed * workers)
+
+    print(f"Books: {len(books)} ({cache.misses} probed, {failed} unreadable)")
+    print(f"Chapters: {len(units) + skipped} ({skipped} done, {len(units)} to encode)")
+    print(f"Audio to encode: {format_duration(seconds)}")
+    print(f"Estimated encode time with {jobs} jobs: {format_duration(estimate)} "
+          f"(at {cache.encode_speed:.1f}x realtime per job)")
+
+def convert_library(library_dir, jobs=1):
+    queue = WorkQueue(library_dir)
+    cache = ProbeCache(library_dir)
+    books, units, skipped, failed = collect_library_units(library_dir, queue, cache)
+
+    print(f"Encoding {len(units)} chapters from {len(books)} books with {jobs} jobs ({skipped} already done)")
+
+    encoded_seconds = 0.0
+    start_time = time.monotonic()
+
+    # One pool over every book's chapters, so small books don't leave cores idle.
+    # Only a small window of chapters is queued at a time, so Ctrl-C waits just
+    # for the ones already encoding.
+    window = max(1, jobs) * 2
+    pending = iter(units)
+    futures = {}
+    num = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        try:
+            while True:
+                for book, out_dir, author, book_title, chapter, key, source in itertools.islice(pending, window - len(futures)):
+                    os.makedirs(out_dir, exist_ok=True)
+                    future = executor.submit(encode_chapter, book, out_dir, author, book_title, chapter)
+                    futures[future] = (book, out_dir, chapter, key, source)
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    book, out_dir, chapter, key, source = futures.pop(future)
+                    num += 1
+                    name = f"{os.path.relpath(book, library_dir)}: {chapter.file_name}"
+                    try:
+                        future.result()
+                    except Exception as e:
+                        queue.mark(key, source, "failed")
+                        failed += 1
+                        print(f"[{num}/{len(units)}] Failed {name} ({e})")
+                        continue
+                    queue.mark(key, source, "done", os.path.join(out_dir, chapter.file_name))
+                    encoded_seconds += chapter_seconds(chapter)
+                    print(f"[{num}/{len(units)}] Done with {name}")
+        except KeyboardInterrupt:
+            print("Interrupted, finished chapters are kept. Run again to continue.")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            queue.close()
+
+    # remember how fast this machine encodes, for --plan
+    elapsed = time.monotonic() - start_time
+    if encoded_seconds > 0 and elapsed > 0:
+        cache.encode_speed = encoded_seconds / elapsed / max(1, min(jobs, len(units)))
+        cache.save()
+
+    return failed
 
 def main(cli_args):
+    if cli_args.plan:
+        plan_library(cli_args.input_file, cli_args.jobs)
+        return
+
+    if cli_args.library:
+        try:
+            failed = convert_library(cli_args.input_file, cli_args.jobs)
+        except KeyboardInterrupt:
+            exit(130)
+        if failed:
+            print(f"{failed} chapters or books failed. Run again to retry them.")
+            exit(1)
+        return
+
     chapters = get_chapters(cli_args.input_file)
     # for c in chapters:
     #     print(c)
-    split_input_into_chapters(
-        cli_args.input_file,
-        cli_args.author,
-        cli_args.book_title,
-        chapters)
+    if cli_args.single_pass:
+        split_input_single_pass(
+            cli_args.input_file,
+            cli_args.author,
+            cli_args.book_title,
+            chapters)
+    else:
+        split_input_into_chapters(
+            cli_args.input_file,
+            cli_args.author,
+            cli_args.book_title,
+            chapters,
+            cli_args.jobs)
 
 
 if __name__ == "__main__":
@@ -133,33 +505,63 @@ if __name__ == "__main__":
     arg_parser.add_argument(
         "input_file",
         metavar="INPUT_FILE",
-        help="The m4b files to break into smaller files."
+        help="The m4b files to break into smaller files (a directory with --library)."
     )
 
     # flags
     arg_parser.add_argument(
         "--author",
         dest="author",
-        required=True,
-        help="The book's author."
+        help="The book's author (required unless --library)."
     )
 
     arg_parser.add_argument(
         "--title",
         dest="book_title",
-        required=True,
-        help="The title of the book."
+        help="The title of the book (required unless --library)."
+    )
+
+    arg_parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of chapters to encode at the same time (default: number of CPUs)."
+    )
+
+    arg_parser.add_argument(
+        "--single-pass",
+        dest="single_pass",
+        action="store_true",
+        help="Decode the input once and encode all chapters from that one pass, instead of one ffmpeg per chapter (--jobs is ignored)."
+    )
+
+    arg_parser.add_argument(
+        "--library",
+        dest="library",
+        action="store_true",
+        help="Convert every m4b file under the INPUT_FILE directory, resuming any earlier run."
+    )
+
+    arg_parser.add_argument(
+        "--plan",
+        dest="plan",
+        action="store_true",
+        help="Report the chapters left to encode under the INPUT_FILE directory and an estimated time, then exit."
     )
 
     args = arg_parser.parse_args()
+    if not (args.library or args.plan) and not (args.author and args.book_title):
+        arg_parser.error("--author and --title are required unless --library is given.")
     main(args)
 
 """
 ffprobe -i 'Fourth Wing: Empyrean, Book 1 [BOBVD25SYT].m4b -print_format json \
     -show_chapters
 
-ffmpeg -i 'Fourth Wing: Empyrean, Book 1 [BOBVD25SYT].m4b' -vn -c libmp3lame \
-    -ss "<start_time>" -to "<end_time>" -metadata title="<tags>.<title>" \
+ffmpeg -ss "<start_time>" -t "<end_time - start_time>" \
+    -i 'Fourth Wing: Empyrean, Book 1 [BOBVD25SYT].m4b' -vn -c libmp3lame \
+    -metadata title="<tags>.<title>" \
     -metadata track="<id> + 1" -map_metadata 0 -id3v2_version 3 \
     "<output_file_name>.mp3"
 
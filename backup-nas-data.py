@@ -7,17 +7,25 @@
 # Features:
 # - Processes multiple backup configurations from a single multi-document YAML file
 # - Automatically discovers and uses the latest ZFS snapshot from the remote server
+# - Discovers mount points and snapshots for all configured datasets in one remote call
+# - Hard links unchanged files against the previous snapshot backup (rsync --link-dest)
+# - Optionally prunes old snapshot backup directories
 # - Creates organized backup directories based on snapshot names
 # - Supports custom rsync arguments per configuration
-# - Generates detailed logs for each backup job in temporary directories
+# - Streams rsync output to a log file for each backup job in a temporary directory
+# - Shows live progress and writes a JSON run report (report.json) next to the logs
 # - Validates remote directories exist before attempting backup
 # - Reports timing and success/failure for each configuration
+# - Optionally runs several configurations at once, with a summary table at the end
+# - Shares one multiplexed SSH connection (ControlMaster) for all remote calls and rsync
 #
 # Usage:
-#   ./backup-nas-data.py [-d DESTINATION_ROOT] [-v]
+#   ./backup-nas-data.py [-d DESTINATION_ROOT] [-j JOBS] [-k KEEP] [-v]
 #
 # Arguments:
 #   -d, --destination-root  Root directory for backups (default: ~/nas_backup)
+#   -j, --jobs             Number of rsync jobs to run at once (default: 1)
+#   -k, --keep-snapshots   Number of snapshot backup directories to keep (default: 0, keep all)
 #   -v, --verbose          Enable verbose output
 #
 # Configuration:
@@ -28,6 +36,7 @@
 #     subdir                   - Subdirectory within dataset (optional)
 #     override_destination_name - Custom destination directory name (optional)
 #     rsync_extra_args         - Additional rsync arguments (optional)
+#     weight                   - Job slots this config takes up with --jobs (optional, default: 1)
 #
 # Exit codes:
 #   0   - Success (all backups completed successfully)
@@ -44,15 +53,23 @@
 #   - PyYAML package (pip install pyyaml)
 
 import argparse
+import json
 import os
+import re
+import shlex
+import shutil
 import sys
 import subprocess
+import threading
 import time
 import yaml
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
 from datetime import datetime
-from tempfile import gettempdir
-from typing import Dict, Iterator
+from tempfile import gettempdir, mkdtemp
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 # Exit codes
 EXIT_SUCCESS = 0
@@ -65,48 +82,262 @@ ENO_OTHER = 100
 # Configuration
 DEFAULT_BACKUP_ROOT_DIR = Path.home() / "nas_backup"
 SSH_HOST = "nas001"
+# The shared SSH connection closes itself after this long without a command on it,
+# so a killed run doesn't leave it open.
+SSH_CONTROL_PERSIST_SECONDS = 60
+PROGRESS_INTERVAL_SECONDS = 30
+RSYNC_STATS_TAIL_LINES = 50
+SNAPSHOT_PREFIX = "auto-weekly-"
+_SECTION_MARKER = "--- snapshots ---"
+# Snapshot backup directories are named after the snapshot date (e.g. 2024-01-07).
+# Only directories like that are ever used as a link reference or pruned.
+SNAPSHOT_DIR_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+@dataclass
+class BackupResult:
+    config_name: str
+    success: bool
+    duration: float = 0.0
+    returncode: Optional[int] = None
+    log_file: str = ""
+    files_total: int = 0
+    files_transferred: int = 0
+    total_file_size: int = 0
+    transferred_file_size: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    speedup: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes received per second"""
+        return self.bytes_received / self.duration if self.duration > 0 else 0.0
+
+    def set_rsync_stats(self, output: str):
+        """Fill in the transfer stats from rsync --stats output"""
+        self.files_total = parse_rsync_stat(output, "Number of files")
+        self.files_transferred = parse_rsync_stat(output, "Number of regular files transferred")
+        self.total_file_size = parse_rsync_stat(output, "Total file size")
+        self.transferred_file_size = parse_rsync_stat(output, "Total transferred file size")
+        self.bytes_sent = parse_rsync_stat(output, "Total bytes sent")
+        self.bytes_received = parse_rsync_stat(output, "Total bytes received")
+        match = re.search(r"speedup is ([\d,.]+)", output)
+        self.speedup = float(match.group(1).replace(',', '')) if match else 0.0
+
+def format_duration(duration: float) -> str:
+    """Format seconds as 00h 00m 00s"""
+    duration = int(duration)
+    hours = duration // 3600
+    minutes = (duration % 3600) // 60
+    seconds = duration % 60
+    return f"{hours:02d}h {minutes:02d}m {seconds:02d}s"
+
+def parse_rsync_stat(output: str, label: str) -> int:
+    """Get a number from rsync --stats output, e.g. 'Total bytes received: 1,234'"""
+    match = re.search(rf"^{re.escape(label)}: ([\d,.]+)", output, re.MULTILINE)
+    if not match:
+        return 0
+    return int(float(match.group(1).replace(',', '')))
+
+@dataclass
+class DatasetInfo:
+    name: str
+    mount_point: str = ""
+    snapshots: List[str] = field(default_factory=list)
+
+@dataclass
+class RemoteCatalog:
+    """Remote metadata for the configured datasets, discovered up front"""
+    datasets: Dict[str, DatasetInfo] = field(default_factory=dict)
+    existing_dirs: Set[str] = field(default_factory=set)
+
+    def mount_point(self, dataset: str) -> str:
+        """Mount point of a dataset, or "" if it has none or wasn't found"""
+        info = self.datasets.get(dataset, None)
+        return info.mount_point if info else ""
+
+    def latest_snapshot(self) -> str:
+        """Latest snapshot name across all datasets, or "" if there are none"""
+        names = {name for info in self.datasets.values() for name in info.snapshots}
+        return max(names) if names else ""
+
+    def dir_exists(self, remote_dir: str) -> bool:
+        return remote_dir in self.existing_dirs
+
+    @staticmethod
+    def discover(ssh: "SshConnection", datasets: Iterable[str]) -> "RemoteCatalog":
+        """
+        Fetch mount points and SNAPSHOT_PREFIX snapshots of the given datasets in
+        a single remote call. Datasets that don't exist are left without a mount
+        point rather than failing the whole call.
+        """
+        catalog = RemoteCatalog({name: DatasetInfo(name) for name in datasets})
+        if not catalog.datasets:
+            return catalog
+
+        names = ' '.join(shlex.quote(name) for name in catalog.datasets)
+        script = (f"zfs get -H -o name,value mountpoint {names}; "
+                  f"echo '{_SECTION_MARKER}'; "
+                  f"zfs list -H -t snapshot -o name -d 1 {names} | grep '@{SNAPSHOT_PREFIX}'; "
+                  f"true")
+        result = ssh.run(script, capture_output=True, text=True, check=True)
+
+        mount_section, _, snapshot_section = result.stdout.partition(f"{_SECTION_MARKER}\n")
+        for line in mount_section.splitlines():
+            name, _, value = line.partition('\t')
+            # 'none', 'legacy' and '-' aren't paths we can reach snapshots through.
+            if name in catalog.datasets and value.startswith('/'):
+                catalog.datasets[name].mount_point = value
+        for line in snapshot_section.splitlines():
+            name, _, snapshot = line.partition('@')
+            if name in catalog.datasets and snapshot.startswith(SNAPSHOT_PREFIX):
+                catalog.datasets[name].snapshots.append(snapshot)
+        for info in catalog.datasets.values():
+            info.snapshots.sort()
+
+        return catalog
+
+    def check_dirs(self, ssh: "SshConnection", remote_dirs: Iterable[str]):
+        """Check which of the given remote directories exist, in a single remote call"""
+        remote_dirs = sorted(set(remote_dirs))
+        if not remote_dirs:
+            return
+        quoted = ' '.join(shlex.quote(d) for d in remote_dirs)
+        script = f"for d in {quoted}; do [ -d \"$d\" ] && printf '%s\\n' \"$d\"; done; true"
+        result = ssh.run(script, capture_output=True, text=True, check=True)
+        self.existing_dirs.update(line for line in result.stdout.splitlines() if line)
+
+class SshConnection:
+    """
+    A shared SSH master connection (ControlMaster) to a remote host.
+
+    Every command and rsync transport started through it reuses the master
+    instead of doing its own handshake. If the master can't be started, commands
+    fall back to plain ssh. Note the remote sshd's MaxSessions (default 10)
+    caps how many commands can share the master at once. The master exits on
+    its own once idle for SSH_CONTROL_PERSIST_SECONDS; commands started after
+    that connect directly.
+    """
+
+    def __init__(self, host: str, verbose: bool = False):
+        self.host = host
+        self.verbose = verbose
+        self.control_dir = ""
+        self.control_path = ""
+
+    def __enter__(self) -> "SshConnection":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def ssh_args(self) -> List[str]:
+        """The ssh command (without host) that reuses the master connection"""
+        if not self.control_path:
+            return ['ssh']
+        return ['ssh', '-o', f'ControlPath={self.control_path}', '-o', 'ControlMaster=no']
+
+    def command(self, *remote_args: str) -> List[str]:
+        """Full command line to run a command on the remote host"""
+        return self.ssh_args() + [self.host, *remote_args]
+
+    def rsync_shell(self) -> str:
+        """Value for rsync's --rsh option so rsync's transport reuses the master connection"""
+        return shlex.join(self.ssh_args())
+
+    def run(self, *remote_args: str, **kwargs) -> subprocess.CompletedProcess:
+        """Run a command on the remote host, passing kwargs on to subprocess.run"""
+        return subprocess.run(self.command(*remote_args), **kwargs)
+
+    def start(self) -> bool:
+        """Start the master connection in the background"""
+        # Socket paths are length limited, so keep it short and private.
+        self.control_dir = mkdtemp(prefix="bnd-ssh-")
+        control_path = os.path.join(self.control_dir, "master")
+        try:
+            subprocess.run([
+                'ssh', '-o', 'ControlMaster=yes', '-o', f'ControlPath={control_path}',
+                '-o', f'ControlPersist={SSH_CONTROL_PERSIST_SECONDS}', '-N', '-f', self.host
+            ], capture_output=True, text=True, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Warning: Could not start shared SSH connection to {self.host}, "
+                  f"falling back to one connection per command: {e.stderr.strip()}")
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = ""
+            return False
+
+        self.control_path = control_path
+        if self.verbose:
+            print(f"Started shared SSH connection to {self.host} ({self.control_path})")
+        return True
+
+    def stop(self):
+        """Close the master connection"""
+        if self.control_path:
+            subprocess.run([
+                'ssh', '-o', f'ControlPath={self.control_path}', '-O', 'exit', self.host
+            ], capture_output=True)
+            self.control_path = ""
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = ""
 
 class BackupExecutor:
-    def __init__(self, destination_root: str, verbose: bool = False):
+    def __init__(self, destination_root: str, verbose: bool = False, jobs: int = 1, keep_snapshots: int = 0):
         self.verbose = verbose
+        self.jobs = max(1, jobs)
+        self.keep_snapshots = max(0, keep_snapshots)
+        self.ssh = SshConnection(SSH_HOST, verbose)
         self.destination_root = Path(destination_root)
         self.snapshot_name = ""
         self.snapshot_date = ""
         self.snapshot_backup_dir = ""
         self.log_dir = ""
+        self.catalog = RemoteCatalog()
 
         self.config_file = self.destination_root / "config.yaml"
 
     def main(self) -> int:
         """Main execution function"""
 
+        # The shared SSH connection lives for the whole run.
+        with self.ssh:
+            return self.run()
+
+    def run(self) -> int:
+        """Process all configurations"""
+
         # Process all configurations from the single YAML file
         configs = list(self.load_all_configs())
         if not configs:
             print(f"No configurations found in {self.config_file}")
             return ENO_BAD_CONFIG_FILE
 
+        if not self.discover_remote(configs):
+            print("Error: Could not discover remote datasets")
+            return ENO_OTHER
+
         if not self.set_snapshot_name():
             print("Error: Could not determine snapshot name")
             return ENO_UNKNOWN_SNAPSHOT
 
+        self.check_remote_dirs(configs)
+
         if not self.set_log_dir():
             print("Error: Could not set log directory")
             return ENO_OTHER
         
-        has_error = False
-        
-        for config, config_name in configs:
-            start_time = time.time()
-            
-            if not self.process_config(config, config_name):
-                has_error = True
-            
-            duration = int(time.time() - start_time)
-            hours = duration // 3600
-            minutes = (duration % 3600) // 60
-            seconds = duration % 60
-            print(f"Elapsed time: {hours:02d}h {minutes:02d}m {seconds:02d}s")
+        start_time = datetime.now()
+        results = self.run_configs(configs)
+        self.print_summary(results)
+        self.write_report(results, start_time)
+        has_error = any(not result.success for result in results)
+
+        # Only prune once this snapshot is fully backed up, or data only in older
+        # snapshot directories could be lost.
+        if self.keep_snapshots and not has_error:
+            self.prune_snapshot_dirs()
         
         if has_error:
             print("One or more configurations had errors.")
@@ -117,6 +348,99 @@ class BackupExecutor:
             print(f"Log files are available in: {self.log_dir}")
             return 0
 
+    def check_remote_dirs(self, configs: List[tuple[Dict, str]]):
+        """Pre-flight check of all remote directories in a single remote call"""
+        remote_dirs = [self.get_remote_dir(config) for config, _ in configs]
+        try:
+            self.catalog.check_dirs(self.ssh, [d for d in remote_dirs if d])
+        except subprocess.CalledProcessError as e:
+            # Every config will then report its directory as missing.
+            print(f"Error: Could not check remote directories on {SSH_HOST}: {e.stderr.strip()}")
+
+    def discover_remote(self, configs: List[tuple[Dict, str]]) -> bool:
+        """Build the remote catalog for all configured datasets"""
+        datasets = {config.get('dataset', '') for config, _ in configs if config}
+        try:
+            self.catalog = RemoteCatalog.discover(self.ssh, sorted(d for d in datasets if d))
+        except subprocess.CalledProcessError as e:
+            print(f"Error: Could not fetch dataset information from remote host {SSH_HOST}: {e.stderr.strip()}")
+            return False
+
+        for info in self.catalog.datasets.values():
+            self.print_verbose(f"Dataset {info.name}: mount point '{info.mount_point}', {len(info.snapshots)} snapshots")
+        return True
+
+    def get_previous_backup_dir(self, destination_dir_name: str) -> Optional[Path]:
+        """Latest earlier snapshot backup of a destination, used as the hard link reference"""
+        for snapshot_dir in reversed(self.list_snapshot_dirs()):
+            if snapshot_dir.name >= self.snapshot_backup_dir.name:
+                continue
+            previous_dir = snapshot_dir / destination_dir_name
+            if previous_dir.is_dir():
+                return previous_dir
+        return None
+
+    def get_remote_dir(self, config: Dict) -> Optional[str]:
+        """Remote snapshot directory to back up for a configuration, or None if it can't be determined"""
+        if not config:
+            return None
+        dataset_mount_point = self.catalog.mount_point(config.get('dataset', ''))
+        if not dataset_mount_point:
+            return None
+
+        remote_dir = f"{dataset_mount_point}/.zfs/snapshot/{self.snapshot_name}".rstrip('/')
+        subdir = config.get('subdir', '')
+        if subdir:
+            remote_dir = f"{remote_dir}/{subdir.lstrip('/')}".rstrip('/')
+        return remote_dir
+
+    def get_weight(self, config: Dict) -> int:
+        """Get the number of job slots a configuration takes up"""
+        try:
+            weight = int((config or {}).get('weight', 1))
+        except (TypeError, ValueError):
+            weight = 1
+        # A config heavier than --jobs would never fit, so it runs on its own.
+        return min(max(1, weight), self.jobs)
+
+    def run_config(self, config: Dict, config_name: str) -> BackupResult:
+        """Process a single configuration and time it"""
+        start_time = time.time()
+        result = self.process_config(config, config_name)
+        result.duration = time.time() - start_time
+        print(f"Elapsed time ({config_name}): {format_duration(result.duration)}")
+        return result
+
+    def run_configs(self, configs: List[tuple[Dict, str]]) -> List[BackupResult]:
+        """
+        Run configurations, up to --jobs slots at once. Each configuration takes
+        up 'weight' slots. Results are returned in configuration order.
+        """
+        results = [None] * len(configs)
+        pending = list(enumerate(configs))
+        slots_used = 0
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+            while pending or futures:
+                # Start configs in order while they fit in the free slots.
+                while pending:
+                    idx, (config, config_name) = pending[0]
+                    weight = self.get_weight(config)
+                    if slots_used + weight > self.jobs:
+                        break
+                    pending.pop(0)
+                    slots_used += weight
+                    futures[executor.submit(self.run_config, config, config_name)] = (idx, weight)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx, weight = futures.pop(future)
+                    slots_used -= weight
+                    results[idx] = future.result()
+
+        return results
+
     def load_all_configs(self) -> Iterator[tuple[Dict, str]]:
         """Load all configuration documents from the single YAML file"""
         try:
@@ -144,7 +468,7 @@ class BackupExecutor:
             print(f"Error loading configurations: {e}")
             return
 
-    def process_config(self, config: Dict, config_name: str) -> bool:
+    def process_config(self, config: Dict, config_name: str) -> BackupResult:
         """Process a single configuration document"""
         print(f"Processing configuration: {config_name}")
         
@@ -152,51 +476,33 @@ class BackupExecutor:
             # Handle empty config documents
             if config is None:
                 print(f"Warning: Empty configuration document for {config_name}")
-                return False
+                return BackupResult(config_name, False)
             
             # Extract configuration values
             dataset = config.get('dataset', '')
-            subdir = config.get('subdir', '')
             override_destination_name = config.get('override_destination_name', '')
             rsync_extra_args = config.get('rsync_extra_args', [])
             
             if not dataset:
                 print(f"Error: dataset not set in configuration {config_name}")
-                return False
+                return BackupResult(config_name, False)
             
             self.print_verbose(f"Dataset: {dataset}")
             
-            # Get dataset mount point via SSH
-            try:
-                result = subprocess.run([
-                    'ssh', SSH_HOST, 'zfs', 'get', '-Ho', 'value', 'mountpoint', dataset
-                ], capture_output=True, text=True, check=True)
-                dataset_mount_point = result.stdout.strip()
-            except subprocess.CalledProcessError:
-                print(f"Error: Could not determine mount point for dataset {dataset}")
-                return False
-            
+            dataset_mount_point = self.catalog.mount_point(dataset)
             self.print_verbose(f"Mount point: {dataset_mount_point}")
             
             if not dataset_mount_point:
                 print(f"Error: Could not determine mount point for dataset {dataset}")
-                return False
+                return BackupResult(config_name, False)
             
-            # Add your backup logic here
-            # This is where the actual backup operations would be implemented
-            remote_dir = f"{dataset_mount_point}/.zfs/snapshot/{self.snapshot_name}".rstrip('/')
-            if subdir:
-                remote_dir = f"{remote_dir}/{subdir.lstrip('/')}".rstrip('/')
+            remote_dir = self.get_remote_dir(config)
             self.print_verbose(f"Remote directory: {remote_dir}")
 
             # Verify remote directory exists
-            try:
-                _ = subprocess.run([
-                    'ssh', SSH_HOST, f"[ -d '{remote_dir}' ]"
-                ], check=True)
-            except subprocess.CalledProcessError:
+            if not self.catalog.dir_exists(remote_dir):
                 print(f"Error: Remote directory {remote_dir} does not exist for dataset {dataset}")
-                return False
+                return BackupResult(config_name, False)
             
             destination_dir_name = override_destination_name if override_destination_name else config_name
             destination_dir = self.snapshot_backup_dir / destination_dir_name
@@ -206,36 +512,130 @@ class BackupExecutor:
                 os.makedirs(destination_dir, exist_ok=False)
             except FileExistsError:
                 print(f"Error: Destination directory {destination_dir} already exists")
-                return False
+                return BackupResult(config_name, False)
             except Exception as e:
                 print(f"Error creating destination directory {destination_dir}: {e}")
-                return False
+                return BackupResult(config_name, False)
+
+            rsync_cmd = ['rsync', '--archive', '--verbose', '--stats', f"--rsh={self.ssh.rsync_shell()}"]
 
-            rsync_cmd = ['rsync', '--archive', '--verbose']
+            # Unchanged files become hard links into the previous backup instead of new copies.
+            previous_backup_dir = self.get_previous_backup_dir(destination_dir_name)
+            if previous_backup_dir:
+                self.print_verbose(f"Link reference: {previous_backup_dir}")
+                rsync_cmd.append(f"--link-dest={previous_backup_dir.resolve()}")
             if rsync_extra_args:
                 rsync_cmd.extend(rsync_extra_args)
             rsync_cmd.extend([f"{SSH_HOST}:{remote_dir}/", f"{destination_dir}/"])
             
-            rsync_proc = subprocess.run(rsync_cmd, capture_output=True, text=True)
-
             log_file_path = self.log_dir / f"{config_name.replace(' ', '_')}.log"
-            with open(log_file_path, 'w') as log_file:
-                log_file.write(f"Rsync command: {' '.join(rsync_cmd)}\n\n")
-                log_file.write("Rsync output:\n")
-                log_file.write(rsync_proc.stdout)
-                log_file.write("\nRsync errors:\n")
-                log_file.write(rsync_proc.stderr)
-
-            if rsync_proc.returncode != 0:
+            result = self.run_rsync(rsync_cmd, log_file_path, config_name)
+
+            if not result.success:
                 print(f"Error: Rsync failed for configuration {config_name}. See log: {log_file_path}")
-                return False
             else:
                 print(f"Backup completed successfully for configuration {config_name}. See log: {log_file_path}")
-                return True
+            return result
             
         except Exception as e:
             print(f"Error processing configuration {config_name}: {e}")
-            return False
+            return BackupResult(config_name, False)
+
+    def run_rsync(self, rsync_cmd: List[str], log_file_path: Path, config_name: str) -> BackupResult:
+        """
+        Run rsync, streaming its output to the log file line by line, and
+        printing progress every PROGRESS_INTERVAL_SECONDS. Only the tail of the
+        output is kept in memory, to parse the --stats summary from.
+        """
+        result = BackupResult(config_name, False, log_file=str(log_file_path))
+        tail = deque(maxlen=RSYNC_STATS_TAIL_LINES)
+        stderr_lines = []
+        start_time = time.time()
+        last_progress = start_time
+        line_count = 0
+
+        with open(log_file_path, 'w') as log_file:
+            log_file.write(f"Rsync command: {' '.join(rsync_cmd)}\n\n")
+            log_file.write("Rsync output:\n")
+
+            rsync_proc = subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                          text=True, errors='replace')
+            # Collect errors on their own thread so a full stderr pipe can't stall rsync.
+            stderr_thread = threading.Thread(target=lambda: stderr_lines.extend(rsync_proc.stderr), daemon=True)
+            stderr_thread.start()
+
+            for line in rsync_proc.stdout:
+                log_file.write(line)
+                tail.append(line)
+                line_count += 1
+
+                now = time.time()
+                if now - last_progress >= PROGRESS_INTERVAL_SECONDS:
+                    log_file.flush()
+                    print(f"[{config_name}] {line_count} entries listed, {format_duration(now - start_time)} elapsed")
+                    last_progress = now
+
+            result.returncode = rsync_proc.wait()
+            stderr_thread.join()
+
+            log_file.write("\nRsync errors:\n")
+            log_file.writelines(stderr_lines)
+
+        result.success = result.returncode == 0
+        result.set_rsync_stats(''.join(tail))
+        return result
+
+    def write_report(self, results: List[BackupResult], start_time: datetime):
+        """Write a machine readable report of the run next to the logs"""
+        report = {
+            'host': SSH_HOST,
+            'snapshot_name': self.snapshot_name,
+            'started': start_time.isoformat(timespec='seconds'),
+            'finished': datetime.now().isoformat(timespec='seconds'),
+            'jobs': self.jobs,
+            'results': [dict(asdict(r), throughput=r.throughput) for r in results],
+        }
+        report_path = self.log_dir / "report.json"
+        try:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Run report written to: {report_path}")
+        except Exception as e:
+            print(f"Error writing run report {report_path}: {e}")
+
+    def list_snapshot_dirs(self) -> List[Path]:
+        """Snapshot backup directories in the destination root, oldest first"""
+        return sorted(
+            p for p in self.destination_root.iterdir()
+            if p.is_dir() and not p.is_symlink() and SNAPSHOT_DIR_PATTERN.match(p.name))
+
+    def prune_snapshot_dirs(self):
+        """Delete the oldest snapshot backup directories, keeping --keep-snapshots of them"""
+        snapshot_dirs = self.list_snapshot_dirs()
+        # Never prune the snapshot just backed up, even if it sorts oddly.
+        snapshot_dirs = [d for d in snapshot_dirs if d != self.snapshot_backup_dir]
+        num_to_delete = len(snapshot_dirs) + 1 - self.keep_snapshots
+        if num_to_delete <= 0:
+            return
+
+        for snapshot_dir in snapshot_dirs[:num_to_delete]:
+            print(f"Pruning old snapshot backup: {snapshot_dir}")
+            try:
+                # Files hard linked into newer backups live on through those links.
+                shutil.rmtree(snapshot_dir)
+            except Exception as e:
+                print(f"Error pruning snapshot backup {snapshot_dir}: {e}")
+
+    def print_summary(self, results: List[BackupResult]):
+        """Print a table of transfer stats for each configuration"""
+        name_width = max([len("Config")] + [len(r.config_name) for r in results])
+        print()
+        print(f"{'Config':<{name_width}}  {'Status':<6}  {'Files':>10}  {'Bytes':>16}  {'Elapsed':>11}  {'MiB/s':>8}")
+        for r in results:
+            status = "OK" if r.success else "FAILED"
+            print(f"{r.config_name:<{name_width}}  {status:<6}  {r.files_transferred:>10}  {r.bytes_received:>16}  "
+                  f"{format_duration(r.duration):>11}  {r.throughput / (1024 * 1024):>8.2f}")
+        print()
 
     def print_verbose(self, *args):
         """Print verbose messages if verbose mode is enabled"""
@@ -255,26 +655,13 @@ class BackupExecutor:
 
 
     def set_snapshot_name(self) -> bool:
-        """Set the snapshot name from remote zfs snapshots"""
-        try:
-            snapshots_raw = subprocess.run([
-                'ssh', SSH_HOST, 'zfs', 'list', '-t', 'snapshot', '-H', '-o', 'name'
-            ], capture_output=True, text=True, check=True)
-            snapshots = snapshots_raw.stdout.strip()
-        except subprocess.CalledProcessError:
-            print(f"Error: Could not fetch snapshots from remote host {SSH_HOST}")
-            return False
-
-        if not snapshots:
-            print(f"Error: No snapshots found on remote host {SSH_HOST}")
+        """Set the snapshot name to the latest snapshot in the remote catalog"""
+        self.snapshot_name = self.catalog.latest_snapshot()
+        if not self.snapshot_name:
+            print(f"Error: No {SNAPSHOT_PREFIX}* snapshots found on remote host {SSH_HOST}")
             return False
 
-        # Extract snapshot names
-        snapshots = [line.split('@')[1] for line in snapshots.split('\n') if line]
-        snapshots = filter(lambda x: x.startswith('auto-weekly-'), snapshots)
-        snapshots = sorted(set(snapshots))
-        self.snapshot_name = snapshots[-1]  # Use the latest snapshot
-        self.snapshot_date = self.snapshot_name.replace('auto-weekly-', '')
+        self.snapshot_date = self.snapshot_name.replace(SNAPSHOT_PREFIX, '')
 
         self.snapshot_backup_dir = self.destination_root / self.snapshot_date
 
@@ -300,6 +687,20 @@ def main():
         default=str(DEFAULT_BACKUP_ROOT_DIR),
         help='The root directory where backups will be stored (default: ~/nas_backup)'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of rsync jobs to run at once (default: 1)'
+    )
+    parser.add_argument(
+        '-k', '--keep-snapshots',
+        action='store',
+        type=int,
+        default=0,
+        help='Number of snapshot backup directories to keep, oldest are deleted (default: 0, keep all)'
+    )
     parser.add_argument(
         '-v', '--verbose', 
         action='store_true',
@@ -312,7 +713,9 @@ def main():
     
     backup_executor = BackupExecutor(
         destination_root=args.destination_root,
-        verbose=args.verbose)
+        verbose=args.verbose,
+        jobs=args.jobs,
+        keep_snapshots=args.keep_snapshots)
     return backup_executor.main()
 
 if __name__ == "__main__":
@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 from enum import Enum
 import itertools
+import json
 import logging
-from os import geteuid, path
+from os import geteuid, makedirs, path, remove, replace
+import re
 from string import Template
 import subprocess
+import threading
 import time
+import urllib.request
+
+import tagged_csv
 
 logger = logging.getLogger(__name__)
 
+# rough costs for the simulate estimate
+ASSUMED_DOWNLOAD_MIB_PER_SECOND = 10
+INSTALL_SECONDS_PER_PACKAGE = {'apt': 2, 'pip': 2, 'snap': 15}
+
+# with --prefetch, batches are this small so the next download overlaps the current install
+PREFETCH_CHUNK_SIZE = 8
+DEFAULT_WHEELHOUSE = '/var/cache/install-packages/wheels'
+DEFAULT_DEB_CACHE = '/var/cache/install-packages/debs'
+# seconds a prefetch waits on a stalled mirror before leaving the deb to apt
+DEB_FETCH_TIMEOUT = 60
+# hash names apt-get --print-uris may print -> hashlib names
+APT_HASH_TYPES = {'SHA512': 'sha512', 'SHA256': 'sha256', 'SHA1': 'sha1', 'MD5Sum': 'md5'}
+
 class ExitCodes(Enum):
     SUCCESS = 0
     GENERAL_ERROR = 1
@@ -23,34 +43,253 @@ class InstallCommands():
     PIP = Template('yes | pip install -q $package')
     SNAP = Template('snap install $package $additional_options')
 
+    # --prefetch fills a deb cache and a pip wheelhouse ahead of the installs,
+    # --offline installs only from them. apt-get install --download-only would
+    # take the dpkg frontend lock the install lane holds, so debs are fetched
+    # from the URIs apt prints (which needs no lock) and apt reads them from
+    # the deb cache used as its archives directory.
+    APT_PRINT_URIS = Template('apt-get install --print-uris -qq -y -o Dir::Cache::archives=$deb_cache $package $additional_options')
+    APT_PREFETCHED = Template('apt-get install -y -o Dir::Cache::archives=$deb_cache $package $additional_options')
+    APT_OFFLINE = Template('apt-get install -y --no-download -o Dir::Cache::archives=$deb_cache $package $additional_options')
+    PIP_DOWNLOAD = Template('pip download -q -d $wheelhouse $package')
+    PIP_PREFETCHED = Template('yes | pip install -q --find-links $wheelhouse $package')
+    PIP_OFFLINE = Template('yes | pip install -q --no-index --find-links $wheelhouse $package')
+
     @staticmethod
-    def get_command(rec):
+    def get_command(rec, stage='install', cache_dirs=None):
+        """
+        Stage is one of install, download, prefetched or offline. cache_dirs
+        holds the wheelhouse and deb_cache directories. Returns an empty
+        string when the provider has no command for the stage.
+        """
         provider = rec['provider']
-        cmd = ''
-        if provider == 'apt':
-            cmd = InstallCommands.APT.substitute(rec)
-        elif provider == 'pip':
-            cmd = InstallCommands.PIP.substitute(rec)
-        elif provider == 'snap':
-            cmd = InstallCommands.SNAP.substitute(rec)
-        return cmd
+        templates = {
+            'apt': {
+                'install': InstallCommands.APT,
+                'download': InstallCommands.APT_PRINT_URIS,
+                'prefetched': InstallCommands.APT_PREFETCHED,
+                'offline': InstallCommands.APT_OFFLINE,
+            },
+            'pip': {
+                'install': InstallCommands.PIP,
+                'download': InstallCommands.PIP_DOWNLOAD,
+                'prefetched': InstallCommands.PIP_PREFETCHED,
+                'offline': InstallCommands.PIP_OFFLINE,
+            },
+            'snap': {
+                'install': InstallCommands.SNAP,
+                'prefetched': InstallCommands.SNAP,
+                'offline': InstallCommands.SNAP,
+            },
+        }
+        template = templates.get(provider, {}).get(stage, None)
+        cache_dirs = cache_dirs or {'wheelhouse': DEFAULT_WHEELHOUSE, 'deb_cache': DEFAULT_DEB_CACHE}
+        return template.substitute(rec, **cache_dirs) if template else ''
+
+    @staticmethod
+    def get_batch_command(batch, stage='install', cache_dirs=None):
+        # rows in a batch share provider and additional_options
+        rec = dict(batch[0])
+        rec['package'] = ' '.join(r['package'] for r in batch)
+        return InstallCommands.get_command(rec, stage, cache_dirs)
+
+class InstallPlanner():
+    """
+    Groups rows into one transaction per provider and set of additional
+    options. Snap takes one snap per command when options are given, so every
+    snap row is its own batch.
+    """
+
+    # providers whose rows may be installed in one command
+    BATCHED_PROVIDERS = ('apt', 'pip')
+
+    @staticmethod
+    def get_batches(data, chunk_size=None):
+        batches = {}
+        for row in data:
+            provider = row['provider']
+            if provider in InstallPlanner.BATCHED_PROVIDERS:
+                key = (provider, row['additional_options'])
+            else:
+                key = (provider, row['package'])
+            batches.setdefault(key, []).append(row)
+
+        ret = {}
+        for (provider, _), batch in batches.items():
+            size = chunk_size or len(batch)
+            for start in range(0, len(batch), size):
+                ret.setdefault(provider, []).append(batch[start:start + size])
+        return ret
+
+    @staticmethod
+    def needs_apt_first(provider, apt_batches):
+        # pip and snap can run next to apt, unless apt is installing the tool itself
+        packages = [r['package'] for b in apt_batches for r in b]
+        if provider == 'pip':
+            return any(p.startswith('python') for p in packages)
+        if provider == 'snap':
+            return 'snapd' in packages
+        return False
 
 def user_is_root():
     return (geteuid() == 0)
 
 def get_csv_data(fp):
-    ret = [r for r in csv.DictReader(fp)]
-    for row in ret:
-        row['tags'] = row['tags'].split(';')
-    return ret
+    return tagged_csv.load(fp)
 
-def filter_data_to_requested_tags(data, requested_tags):
-    def is_package_tag_requested(data_item):
-        intersect = [value for value in data_item['tags'] if value in requested_tags]
-        return len(intersect) > 0
-    
-    ret = filter(is_package_tag_requested, data)
-    return ret
+def get_base_name(package):
+    # drop version specifiers and extras, e.g. "black[d]>=23" -> "black"
+    return re.split(r'[<>=!~\[;@ ]', package.strip(), maxsplit=1)[0]
+
+def normalize_pip_name(package):
+    return re.sub(r'[-_.]+', '-', get_base_name(package)).lower()
+
+def run_query(cmd):
+    """Run a read-only query command. Returns its stdout, or None if the tool is missing."""
+    try:
+        ret = subprocess.run(
+            cmd,
+            encoding='utf-8',
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return None
+    return ret.stdout
+
+def get_installed_packages(provider, packages):
+    """Return the subset of packages (as given in the csv) that are already installed."""
+    if not packages:
+        return set()
+
+    if provider == 'apt':
+        out = run_query(['dpkg-query', '-W', '-f=${Package} ${db:Status-Status}\n',
+                         *[get_base_name(p) for p in packages]]) or ''
+        names = {line.split()[0] for line in out.splitlines() if line.endswith(' installed')}
+        return {p for p in packages if get_base_name(p) in names}
+    elif provider == 'pip':
+        out = run_query(['pip', 'show', *[get_base_name(p) for p in packages]]) or ''
+        names = {normalize_pip_name(line[5:]) for line in out.splitlines() if line.startswith('Name:')}
+        return {p for p in packages if normalize_pip_name(p) in names}
+    elif provider == 'snap':
+        out = run_query(['snap', 'list']) or ''
+        names = {line.split()[0] for line in out.splitlines()[1:] if line.strip()}
+        return {p for p in packages if p in names}
+    return set()
+
+def filter_installed(data):
+    by_provider = {}
+    for row in data:
+        by_provider.setdefault(row['provider'], []).append(row['package'])
+
+    installed = {
+        (provider, p)
+        for provider, packages in by_provider.items()
+        for p in get_installed_packages(provider, packages)
+    }
+    return [row for row in data if (row['provider'], row['package']) not in installed]
+
+class ProviderPlan():
+    """What installing a provider's packages would do, as far as the provider can tell without doing it."""
+
+    def __init__(self, provider, packages):
+        self.provider = provider
+        self.packages = packages
+        self.closure = []
+        self.download_bytes = None
+        self.installed_bytes = None
+        self.errors = []
+
+    @property
+    def seconds(self):
+        download = (self.download_bytes or 0) / (ASSUMED_DOWNLOAD_MIB_PER_SECOND * 1024 * 1024)
+        return download + INSTALL_SECONDS_PER_PACKAGE.get(self.provider, 0) * len(self.closure)
+
+    @staticmethod
+    def resolve(provider, packages):
+        plan = ProviderPlan(provider, packages)
+        if provider == 'apt':
+            plan._resolve_apt()
+        elif provider == 'pip':
+            plan._resolve_pip()
+        else:
+            # snaps bundle their dependencies
+            plan.closure = list(packages)
+        return plan
+
+    def _resolve_apt(self):
+        names = [get_base_name(p) for p in self.packages]
+        out = run_query(['apt-get', 'install', '-s', '-y', *names])
+        if out is None:
+            self.errors.append('apt-get not found')
+            return
+        # "Inst name (version ...)" for every package apt would unpack
+        self.closure = [line.split()[1] for line in out.splitlines() if line.startswith('Inst ')]
+        if not self.closure:
+            if 'newly installed' not in out:
+                self.errors.append('apt-get could not resolve the packages (run apt-get install -s to see why)')
+            return
+
+        # "'uri' file_name size hash" for every .deb that isn't in the cache yet
+        out = run_query(['apt-get', 'install', '--print-uris', '-qq', '-y', *names]) or ''
+        self.download_bytes = sum(int(line.split()[2]) for line in out.splitlines() if line.startswith("'"))
+
+        out = run_query(['apt-cache', 'show', '--no-all-versions', *self.closure]) or ''
+        self.installed_bytes = sum(
+            int(line.split(':', 1)[1]) * 1024 for line in out.splitlines() if line.startswith('Installed-Size:'))
+
+    def _resolve_pip(self):
+        out = run_query(['pip', 'install', '--dry-run', '--quiet', '--report', '-', *self.packages])
+        if not out:
+            self.errors.append('pip could not resolve the packages (pip 22.2 or later is needed)')
+            return
+        report = json.loads(out)
+        self.closure = [i['metadata']['name'] for i in report.get('install', [])]
+
+def format_bytes(num):
+    if num is None:
+        return 'unknown'
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if num < 1024 or unit == 'GiB':
+            return f'{num:.1f} {unit}' if unit != 'B' else f'{num} {unit}'
+        num /= 1024
+
+def format_seconds(seconds):
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return f'{int(hours):0>2}:{int(minutes):0>2}:{int(seconds):0>2}'
+
+def print_install_plan(data, skipped):
+    """
+    Resolve what each provider would install and estimate the run time. Providers
+    run in parallel (see perform_install), so the estimate is the longest chain.
+    """
+    by_provider = {}
+    for row in data:
+        by_provider.setdefault(row['provider'], []).append(row['package'])
+
+    plans = {provider: ProviderPlan.resolve(provider, packages) for provider, packages in by_provider.items()}
+    apt_batches = [[{'package': p} for p in by_provider.get('apt', [])]]
+
+    print(f'{skipped} packages already installed.')
+    critical = {}
+    for provider, plan in plans.items():
+        print(f'{provider}: {len(plan.packages)} requested, {len(plan.closure)} to install '
+              f'including dependencies, download {format_bytes(plan.download_bytes)}, '
+              f'installed size {format_bytes(plan.installed_bytes)}, about {format_seconds(plan.seconds)}')
+        for p in plan.packages:
+            print(f'  {p}')
+        for error in plan.errors:
+            print(f'  ! {error}')
+
+        critical[provider] = plan.seconds
+        if provider != 'apt' and 'apt' in plans and InstallPlanner.needs_apt_first(provider, apt_batches):
+            critical[provider] += plans['apt'].seconds
+
+    total = sum(plan.seconds for plan in plans.values())
+    longest = max(critical, key=critical.get) if critical else None
+    if longest:
+        print(f'Estimated time: {format_seconds(critical[longest])} (critical path ends with {longest}; '
+              f'{format_seconds(total)} if run one provider at a time)')
 
 def compute_elapsed_time(start):
     end = time.perf_counter()
@@ -59,51 +298,213 @@ def compute_elapsed_time(start):
     ret = f'{int(hours):0>2}:{int(minutes):0>2}:{int(seconds):0>2}' 
     return ret
 
-def perform_install(data, options):
+def run_install_command(cmd):
+    return subprocess.run(
+        cmd,
+        check=True,
+        encoding='utf-8',
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+def file_hash(file_name, hash_name):
+    digest = hashlib.new(hash_name)
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fetch_deb(uri, file_name, size, checksum, deb_cache):
+    """
+    Download one deb into the deb cache, checking its size and the hash apt
+    printed for it. apt trusts a cached deb of the right size, so a deb whose
+    hash can't be checked is never cached.
+    """
+    hash_type, _, expected = checksum.partition(':')
+    hash_name = APT_HASH_TYPES.get(hash_type)
+    if not hash_name or not expected:
+        raise ValueError(f'{file_name}: cannot verify checksum "{checksum}", leaving it to apt')
+
+    target = path.join(deb_cache, file_name)
+    if path.isfile(target) and path.getsize(target) == size and file_hash(target, hash_name) == expected.lower():
+        return
+
+    digest = hashlib.new(hash_name)
+    part_file = f'{target}.part'
+    try:
+        with urllib.request.urlopen(uri, timeout=DEB_FETCH_TIMEOUT) as response, open(part_file, 'wb') as f:
+            for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        if path.getsize(part_file) != size:
+            raise ValueError(f'{file_name}: expected {size} bytes, got {path.getsize(part_file)}')
+        if digest.hexdigest() != expected.lower():
+            raise ValueError(f'{file_name}: {hash_type} mismatch')
+        replace(part_file, target)
+    finally:
+        if path.exists(part_file):
+            remove(part_file)
+
+def prefetch_apt_batch(batch, cache_dirs):
+    # "'uri' file_name size checksum" for every deb apt still needs
+    ret = run_install_command(InstallCommands.get_batch_command(batch, 'download', cache_dirs))
+    for line in ret.stdout.splitlines():
+        if not line.startswith("'"):
+            continue
+        uri, file_name, size, checksum = line.split()[:4]
+        uri = uri.strip("'")
+        if uri.split(':', 1)[0] not in ('http', 'https', 'file'):
+            # other apt transports (tor+, mirror+, ...) are left to the install
+            continue
+        try:
+            fetch_deb(uri, file_name, int(size), checksum, cache_dirs['deb_cache'])
+        except (OSError, ValueError) as e:
+            # apt downloads (and verifies) whatever wasn't cached itself
+            logger.warning(f'Prefetching {file_name} failed: {e}')
+
+def prefetch_batches(batches, fetched, cache_dirs):
+    """
+    Download each batch ahead of its install, setting the batch's event when
+    done. A failed download is only logged; the install then fetches it itself.
+    Nothing here takes the dpkg lock, so it runs while apt installs.
+    """
+    try:
+        for batch in batches:
+            try:
+                if batch[0]['provider'] == 'apt':
+                    prefetch_apt_batch(batch, cache_dirs)
+                else:
+                    cmd = InstallCommands.get_batch_command(batch, 'download', cache_dirs)
+                    if cmd:
+                        run_install_command(cmd)
+            except subprocess.CalledProcessError as e:
+                logger.warning(f'Prefetching {len(batch)} {batch[0]["provider"]} packages failed: {e.stderr.strip() or e}')
+            except (OSError, ValueError) as e:
+                logger.warning(f'Prefetching {len(batch)} {batch[0]["provider"]} packages failed: {e}')
+            fetched[id(batch)].set()
+    finally:
+        # never leave an install lane waiting
+        for batch in batches:
+            fetched[id(batch)].set()
+
+def install_batches(batches, report, stage='install', cache_dirs=None, fetched=None):
+    """
+    Install each batch in one command. When a batch fails, its packages are
+    installed one at a time so a single bad package doesn't fail the rest.
+    With prefetching, each batch waits for its download to finish first.
+    """
+    for batch in batches:
+        if fetched and id(batch) in fetched:
+            fetched[id(batch)].wait()
+
+        try:
+            run_install_command(InstallCommands.get_batch_command(batch, stage, cache_dirs))
+            for item in batch:
+                report(item, None)
+            continue
+        except subprocess.CalledProcessError as e:
+            if len(batch) == 1:
+                report(batch[0], e.stderr.strip() or str(e))
+                continue
+            logger.warning(f'Batch of {len(batch)} {batch[0]["provider"]} packages failed, installing one at a time.')
+
+        for item in batch:
+            try:
+                run_install_command(InstallCommands.get_command(item, stage, cache_dirs))
+                report(item, None)
+            except subprocess.CalledProcessError as e:
+                report(item, e.stderr.strip() or str(e))
+
+def perform_install(table, options):
     start_time = time.perf_counter()
-    data_count_orig = len(data)
-    data = list(filter_data_to_requested_tags(data, options.tags))
+    data_count_orig = len(table.rows)
+    data = table.query_any(options.tags)
+    data_count_tagged = len(data)
+    if not options.reinstall:
+        data = filter_installed(data)
     data_count_try = len(data)
 
-    print(f'Installing {data_count_try} of {data_count_orig} packages with tags {", ".join(sorted(options.tags))}...')
+    if options.simulate:
+        print(f'Planning {data_count_tagged} of {data_count_orig} packages with tags {", ".join(sorted(options.tags))}...')
+        print_install_plan(data, data_count_tagged - data_count_try)
+        return True
 
-    for num, item in enumerate(data, start=1):
-        elapsed_time = compute_elapsed_time(start_time)
-        cmd = InstallCommands.get_command(item)
+    print(f'Installing {data_count_try} of {data_count_orig} packages with tags {", ".join(sorted(options.tags))} '
+          f'({data_count_tagged - data_count_try} already installed)...')
 
-        print(f'[{elapsed_time}]({num}/{data_count_try}) {item["package"]}')        
+    lock = threading.Lock()
+    done = []
+    failures = []
 
-        if options.simulate:
-            print(cmd)
-            time.sleep(1.27)
-        else:
-            subprocess.run(
-                cmd,
-                check=True,
-                encoding='utf-8',
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
+    def report(item, error):
+        with lock:
+            done.append(item)
+            elapsed_time = compute_elapsed_time(start_time)
+            status = 'ok' if error is None else 'FAILED'
+            print(f'[{elapsed_time}]({len(done)}/{data_count_try}) {item["package"]} ({item["provider"]}) {status}')
+            if error is not None:
+                failures.append((item, error))
+
+    prefetch = options.prefetch and not options.offline
+    stage = 'offline' if options.offline else 'prefetched' if prefetch else 'install'
+    batches = InstallPlanner.get_batches(data, PREFETCH_CHUNK_SIZE if prefetch else None)
+    apt_batches = batches.get('apt', [])
+    cache_dirs = {'wheelhouse': options.wheelhouse, 'deb_cache': options.deb_cache}
+    if prefetch or options.offline:
+        makedirs(options.wheelhouse, exist_ok=True)
+        # apt wants a partial/ directory in any archives directory it uses
+        makedirs(path.join(options.deb_cache, 'partial'), exist_ok=True)
+
+    # one downloader walks apt and pip batches in turn, so both install lanes are fed
+    fetched = {}
+    prefetch_order = []
+    if prefetch:
+        for apt_batch, pip_batch in itertools.zip_longest(apt_batches, batches.get('pip', [])):
+            prefetch_order.extend(b for b in (apt_batch, pip_batch) if b)
+        fetched = {id(b): threading.Event() for b in prefetch_order}
+
+    # apt gets the dpkg lock to itself; pip and snap run alongside it
+    with ThreadPoolExecutor(max_workers=len(batches) + 2) as executor:
+        if prefetch_order:
+            executor.submit(prefetch_batches, prefetch_order, fetched, cache_dirs)
+
+        apt_future = executor.submit(install_batches, apt_batches, report, stage, cache_dirs, fetched)
+
+        def install_provider(provider):
+            if InstallPlanner.needs_apt_first(provider, apt_batches):
+                apt_future.result()
+            install_batches(batches[provider], report, stage, cache_dirs, fetched)
+
+        futures = [executor.submit(install_provider, p) for p in batches if p != 'apt']
+        for future in [apt_future, *futures]:
+            future.result()
+
+    print(f'[{compute_elapsed_time(start_time)}] Installed {data_count_try - len(failures)} of {data_count_try} packages.')
+    for item, error in failures:
+        logger.error(f'{item["package"]} ({item["provider"]}): {error}')
+
+    return len(failures) == 0
 
 def main(options):
     if not options.simulate and not user_is_root():
         logger.error('Not running as root user, aborting.')
         exit(ExitCodes.INVALID_USER)
 
-    data = get_csv_data(options.file)
+    table = get_csv_data(options.file)
     if options.list_tags:
-        data = sorted(
-            set(
-                itertools.chain.from_iterable(
-                    map(lambda x: x['tags'], data))))
-
-        for item in data:
+        for item in table.tags():
             print(item)
     else:
         if len(options.tags) < 2 and options.tags[0] == 'any':
             logger.warning('Tags contains only "any". Only packages with "any" tag will be installed.')
         
-        perform_install(data, options)
+        try:
+            success = perform_install(table, options)
+        except tagged_csv.TagExpressionError as e:
+            logger.error(str(e))
+            exit(ExitCodes.GENERAL_ERROR)
+        if not success:
+            exit(ExitCodes.GENERAL_ERROR)
 
 
 if __name__ == '__main__':
@@ -132,14 +533,43 @@ if __name__ == '__main__':
     parser.add_argument(
         '--simulate',
         action='store_true',
-        help='Print what would be done, but don\'t actually do anything'
+        help='Print what would be installed (with dependencies, download size and an estimated time), but don\'t actually do anything'
+    )
+    parser.add_argument(
+        '--prefetch',
+        action='store_true',
+        help='Download upcoming apt and pip packages while earlier ones install (into --deb-cache and --wheelhouse)'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Install apt and pip packages only from the --deb-cache and --wheelhouse filled by an earlier --prefetch run'
+    )
+    parser.add_argument(
+        '--wheelhouse',
+        default=DEFAULT_WHEELHOUSE,
+        metavar='DIR',
+        help=f'Where --prefetch keeps downloaded pip packages (default {DEFAULT_WHEELHOUSE})'
+    )
+    parser.add_argument(
+        '--deb-cache',
+        default=DEFAULT_DEB_CACHE,
+        metavar='DIR',
+        help=f'Where --prefetch keeps downloaded apt packages (default {DEFAULT_DEB_CACHE})'
+    )
+    parser.add_argument(
+        '--reinstall',
+        action='store_true',
+        help='Run installs for packages that are already installed instead of skipping them'
     )
     parser.add_argument(
         '-t', '--tags',
         dest='tags',
         metavar='TAG',
         nargs='+',
-        help='Tags assoicated with packages to install (in addition to "any")'
+        help='Tags assoicated with packages to install (in addition to "any"). '
+             'A tag may also be an expression such as "dev and not gui"; '
+             'quote tags with spaces or operators in them, e.g. "\'my tag\' and dev"'
     )
 
     options = parser.parse_args()
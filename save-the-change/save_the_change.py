@@ -1,68 +1,117 @@
 # pylint: disable=missing-docstring
 
+from array import array
 import csv
-from datetime import datetime
-import itertools
-import math
+from datetime import date
+from decimal import Decimal, ROUND_HALF_EVEN
 import sys
 
+# rows parsed per chunk; memory stays bounded however long the export is
+CHUNK_ROWS = 64 * 1024
+
 def main():
     in_file = sys.argv[1]
-    records = get_valid_records(in_file)
-   
-    print_amount("Transaction", records, calculate_by_transaction)
-    print_amount("Day", records, calculate_by_day)
-    print_amount("Week", records, calculate_by_week)
+    totals = RoundUpTotals()
 
+    for days, weeks, cents in read_chunks(in_file):
+        totals.add_chunk(days, weeks, cents)
+    totals.finish()
 
-def get_valid_records(file_path):
-    result = []
+    print_amount("Transaction", totals.by_transaction)
+    print_amount("Day", totals.by_day)
+    print_amount("Week", totals.by_week)
 
-    with open(file_path, 'r') as f:
-        reader = csv.reader(f, delimiter=',')
 
-        for row in reader:
-            record = (
-                datetime.strptime(row[0], '%m/%d/%Y').date(),
-                float(row[1]))
+def parse_cents(text):
+    # exact, unlike float: "12.10" is 1210 cents, not 1209.9999...
+    return int((Decimal(text) * 100).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
 
-            if record[1] < 0:
-                result.append(record)
+def read_chunks(file_path, chunk_rows=CHUNK_ROWS):
+    """
+    Parse the export into columnar chunks of (ordinal day, ISO week key,
+    cents) for the charges (negative amounts), cents made positive.
+    """
+    days = array('l')
+    weeks = array('l')
+    cents = array('q')
+    last_ordinal = None
+    last_week = None
 
-    return result
+    with open(file_path, 'r') as f:
+        reader = csv.reader(f, delimiter=',')
 
-def print_amount(amount_type, records, func):
+        for row in reader:
+            amount = parse_cents(row[1])
+            if amount >= 0:
+                continue
+
+            month, day, year = row[0].split('/')
+            ordinal = date(int(year), int(month), int(day)).toordinal()
+            if ordinal != last_ordinal:
+                iso = date.fromordinal(ordinal).isocalendar()
+                last_ordinal = ordinal
+                last_week = iso[0] * 100 + iso[1]
+
+            days.append(ordinal)
+            weeks.append(last_week)
+            cents.append(-amount)
+
+            if len(cents) >= chunk_rows:
+                yield days, weeks, cents
+                days = array('l')
+                weeks = array('l')
+                cents = array('q')
+
+    if cents:
+        yield days, weeks, cents
+
+def round_up(cents):
+    """Cents needed to round up to the next whole dollar."""
+    return -cents % 100
+
+class RoundUpTotals():
+    """
+    Round-up totals in integer cents for all three groupings, computed in one
+    pass. Like the export itself, days and weeks are grouped by runs of
+    consecutive rows; a group still open at the end of a chunk carries over to
+    the next one.
+    """
+
+    def __init__(self):
+        self.by_transaction = 0
+        self.by_day = 0
+        self.by_week = 0
+        self._day = None
+        self._day_cents = 0
+        self._week = None
+        self._week_cents = 0
+
+    def add_chunk(self, days, weeks, cents):
+        for day, week, amount in zip(days, weeks, cents):
+            self.by_transaction += round_up(amount)
+
+            if day != self._day:
+                self.by_day += round_up(self._day_cents)
+                self._day = day
+                self._day_cents = 0
+            self._day_cents += amount
+
+            if week != self._week:
+                self.by_week += round_up(self._week_cents)
+                self._week = week
+                self._week_cents = 0
+            self._week_cents += amount
+
+    def finish(self):
+        self.by_day += round_up(self._day_cents)
+        self.by_week += round_up(self._week_cents)
+        self._day_cents = 0
+        self._week_cents = 0
+
+def print_amount(amount_type, cents):
+    # the summary itself is rounded up to the dollar too
     print(
-        f"Amount by {amount_type}: $ {int(math.ceil(func(records)))}")
-
-def calculate_by_transaction(records):
-    result = 0.0
-
-    for _, amount in records:
-        fabs_amount = math.fabs(amount)
-        result += math.ceil(fabs_amount) - fabs_amount
-
-    return result
-
-def calculate_by_day(records):
-    groups = itertools.groupby(records, lambda r: r[0].toordinal())
-
-    result = 0.0
-    for _, group in groups:
-        fabs_daily = math.fsum([math.fabs(amount) for _, amount in group])
-        result += math.ceil(fabs_daily) - fabs_daily
-
-    return result
-
-def calculate_by_week(records):
-    groups = itertools.groupby(records, lambda r: r[0].isocalendar()[1])
-
-    result = 0.0
-    for _, group in groups:
-        fabs_weekly = math.fsum([math.fabs(amount) for _, amount in group])
-        result += math.ceil(fabs_weekly) - fabs_weekly
-
-    return result
+        f"Amount by {amount_type}: $ {-(-cents // 100)}")
 
 if __name__ == '__main__':
     main()
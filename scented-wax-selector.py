@@ -1,21 +1,102 @@
 #!/usr/bin/env python3
 import argparse
-from csv import DictReader
-from random import choice
+import json
+import os
+import random
+
+import tagged_csv
+
+_DEFAULT_HISTORY_SIZE = 5
 
 _SCRIPT_DESCRIPTION = """
 Given csv file containing the names of scented waxes in the format of
 {name,tags}, script will randomly choose an item from the list. Can pass
-specific tags to the script to limit the options to pick from.
+specific tags to the script to limit the options to pick from. A tag may also
+be an expression such as "floral and not strong"; quote tags with spaces or
+operators in them, e.g. "'hand made' and not strong".
+
+An optional "weight" column makes some items more likely to be picked (default
+weight is 1, 0 never picks the item). Recent picks are remembered and skipped,
+so the same wax doesn't come up again right away. The parsed csv is cached, so
+repeated runs (e.g. from a launcher) start quickly.
 """
 
-def filter_to_requested_tags(data, requested_tags):
-    def is_tag_requested(data_item):
-        # set intersection
-        matches = (requested_tags & set(data_item["tags"]))
-        return len(matches) > 0
+class AliasSampler():
+    """
+    Weighted sampling in O(1) per pick using Vose's alias method. Building the
+    tables is O(n).
+    """
+
+    def __init__(self, weights, rng=random):
+        self.rng = rng
+        count = len(weights)
+        total = sum(weights)
+        if count == 0 or total <= 0:
+            raise ValueError("Nothing to pick from.")
+
+        scaled = [w * count / total for w in weights]
+        self.prob = [0.0] * count
+        self.alias = [0] * count
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+        # what's left is 1 give or take rounding
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def pick(self):
+        i = self.rng.randrange(len(self.prob))
+        return i if self.rng.random() < self.prob[i] else self.alias[i]
 
-    return data if "*" in requested_tags else filter(is_tag_requested, data)
+def get_weight(item):
+    value = (item.get("weight") or "").strip()
+    return max(0.0, float(value)) if value else 1.0
+
+def pick_items(items, count, rng=random):
+    """
+    Pick up to count different items, weighted by their weight column. A
+    repeat is redrawn; once repeats get common the tables are rebuilt without
+    the items already picked.
+    """
+    remaining = [i for i in items if get_weight(i) > 0]
+    picks = []
+    while len(picks) < count and remaining:
+        sampler = AliasSampler([get_weight(i) for i in remaining], rng)
+        picked = set()
+        misses = 0
+        while len(picks) < count and misses < len(remaining):
+            index = sampler.pick()
+            if index in picked:
+                misses += 1
+                continue
+            picked.add(index)
+            picks.append(remaining[index])
+        remaining = [item for i, item in enumerate(remaining) if i not in picked]
+    return picks
+
+def get_history_file():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(state_home, "scented-wax-selector", "history.json")
+
+def load_history(history_file):
+    try:
+        with open(history_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_history(history_file, history):
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    with open(f"{history_file}.part", "w") as f:
+        json.dump(history, f)
+    os.replace(f"{history_file}.part", history_file)
 
 def main():
     parser = argparse.ArgumentParser(description=_SCRIPT_DESCRIPTION)
@@ -26,7 +107,7 @@ def main():
         default=["*"],
         metavar="TAG",
         nargs="*",
-        help="the tag(s) of items to pick from.")
+        help="the tag(s) (or tag expressions) of items to pick from.")
     # flags
     parser.add_argument(
         "--data",
@@ -34,17 +115,48 @@ def main():
         required=True,
         type=argparse.FileType("r"),
         help="path to the csv file containing items to pick from.")
+    parser.add_argument(
+        "-n", "--count",
+        dest="count",
+        type=int,
+        default=1,
+        help="number of different items to pick.")
+    parser.add_argument(
+        "--history",
+        dest="history_size",
+        type=int,
+        default=_DEFAULT_HISTORY_SIZE,
+        help=f"number of recent picks to avoid (0 to turn off). Default {_DEFAULT_HISTORY_SIZE}.")
     args = parser.parse_args()
 
-    data = [r for r in DictReader(args.file)]
-    for row in data:
-        row["tags"] = row["tags"].split(";")
+    table = tagged_csv.load(args.file)
+    try:
+        data = table.query_any(args.tags)
+    except tagged_csv.TagExpressionError as e:
+        parser.error(str(e))
+    try:
+        data = [i for i in data if get_weight(i) > 0]
+    except ValueError as e:
+        parser.error(f"Invalid weight in {args.file.name}: {e}")
+    if not data:
+        parser.exit(1, "No items match the given tags.\n")
+
+    history_file = get_history_file()
+    history = load_history(history_file) if args.history_size > 0 else []
+
+    # skip recent picks, unless that leaves too few to choose from
+    fresh = [i for i in data if i["name"] not in history]
+    picks = pick_items(fresh if len(fresh) >= args.count else data, args.count)
 
-    data = list(filter_to_requested_tags(data, set(args.tags)))
-    pick = dict(choice(data))
+    for num, pick in enumerate(picks):
+        if num > 0:
+            print()
+        print(f"Name: {pick['name']}")
+        print(f"Tags: {pick['tags']}")
 
-    print(f"Name: {pick['name']}")
-    print(f"Tags: {pick['tags']}")
+    if args.history_size > 0:
+        history = [p["name"] for p in picks] + [h for h in history if h not in {p["name"] for p in picks}]
+        save_history(history_file, history[:args.history_size])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
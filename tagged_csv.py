@@ -0,0 +1,196 @@
+"""
+Shared loader for csv files with a ';' separated "tags" column, as used by
+install-packages.py and scented-wax-selector.py.
+
+The file is parsed once into an inverted tag -> row ids index, and tag
+expressions are answered with set operations on it. Expressions combine tags
+with "and", "or", "not" (or "&", "|", "!") and parentheses, e.g.
+"dev and not gui" or "(floral | citrus) & !strong". "*" matches every row.
+Tags with spaces or any of ()&|!"' in them, or spelled like an operator or
+"*", are quoted, e.g. "'hand made' and not 'or'"; inside quotes a backslash
+escapes the next character. The parsed index is cached on disk and reused until the file's modification
+time or size changes.
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+
+_CACHE_VERSION = 1
+
+# an operator, a quoted tag or a bare tag
+_TOKEN_PATTERN = re.compile(r"""\s*(?:([()&|!])|"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|([^\s()&|!"']+))""")
+
+_ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+_OPERATORS = {'and': '&', 'or': '|', 'not': '!'}
+
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'tagged-csv')
+
+class TagExpressionError(ValueError):
+    pass
+
+class _ParseError(Exception):
+    pass
+
+def _tokenize(expression):
+    """
+    Split a tag expression into (operator, tag, offset) tokens, "*" being an
+    operator. Exactly one of operator and tag is set; quoted tags never become
+    operators.
+    """
+    tokens = []
+    pos = 0
+    while True:
+        match = _TOKEN_PATTERN.match(expression, pos)
+        if not match:
+            break
+        operator, double_quoted, single_quoted, bare = match.groups()
+        offset = match.start(match.lastindex)
+        if operator:
+            tokens.append((operator, None, offset))
+        elif bare is not None:
+            if bare.lower() in _OPERATORS:
+                tokens.append((_OPERATORS[bare.lower()], None, offset))
+            elif bare == '*':
+                tokens.append(('*', None, offset))
+            else:
+                tokens.append((None, bare, offset))
+        else:
+            quoted = double_quoted if double_quoted is not None else single_quoted
+            tokens.append((None, _ESCAPE_PATTERN.sub(r'\1', quoted), offset - 1))
+        pos = match.end()
+
+    rest = expression[pos:]
+    if rest.strip():
+        raise _ParseError(f'Unterminated quote at position {len(expression) - len(rest.lstrip()) + 1}')
+    return tokens
+
+class TaggedCsv():
+
+    def __init__(self, rows, index=None):
+        self.rows = rows
+        if index is not None:
+            self.index = {tag: set(ids) for tag, ids in index.items()}
+            return
+
+        self.index = {}
+        for row_id, row in enumerate(rows):
+            for tag in row['tags']:
+                self.index.setdefault(tag, set()).add(row_id)
+
+    def tags(self):
+        return sorted(self.index)
+
+    def query(self, expression):
+        """Return the rows matching a tag expression, in file order."""
+        return [self.rows[i] for i in sorted(self._evaluate(expression))]
+
+    def query_any(self, tags):
+        """Return the rows matching any of tags, each of which may be an expression."""
+        ids = set()
+        for tag in tags:
+            ids |= self._evaluate(tag)
+        return [self.rows[i] for i in sorted(ids)]
+
+    def _evaluate(self, expression):
+        if not expression.strip():
+            raise TagExpressionError('Empty tag expression.')
+
+        try:
+            tokens = _tokenize(expression)
+            pos, ids = self._parse_or(tokens, 0)
+            if pos != len(tokens):
+                raise _ParseError(_unexpected(tokens[pos]))
+        except _ParseError as e:
+            raise TagExpressionError(f'{e} in tag expression: {expression}') from None
+        return ids
+
+    # expression := term ('|' term)*
+    # term       := factor ('&' factor)*
+    # factor     := '!' factor | '(' expression ')' | '*' | tag
+    def _parse_or(self, tokens, pos):
+        pos, ids = self._parse_and(tokens, pos)
+        while pos < len(tokens) and tokens[pos][0] == '|':
+            pos, rhs = self._parse_and(tokens, pos + 1)
+            ids = ids | rhs
+        return pos, ids
+
+    def _parse_and(self, tokens, pos):
+        pos, ids = self._parse_factor(tokens, pos)
+        while pos < len(tokens) and tokens[pos][0] == '&':
+            pos, rhs = self._parse_factor(tokens, pos + 1)
+            ids = ids & rhs
+        return pos, ids
+
+    def _parse_factor(self, tokens, pos):
+        if pos >= len(tokens):
+            raise _ParseError('Unexpected end')
+
+        operator, tag, offset = tokens[pos]
+        if operator == '!':
+            pos, ids = self._parse_factor(tokens, pos + 1)
+            return pos, set(range(len(self.rows))) - ids
+        if operator == '(':
+            pos, ids = self._parse_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos][0] != ')':
+                raise _ParseError(f'Missing ")" for the "(" at position {offset + 1}')
+            return pos + 1, ids
+        if operator == '*':
+            return pos + 1, set(range(len(self.rows)))
+        if operator:
+            raise _ParseError(_unexpected(tokens[pos]))
+        return pos + 1, self.index.get(tag, set())
+
+def _unexpected(token):
+    operator, tag, offset = token
+    return f'Unexpected "{operator or tag}" at position {offset + 1}'
+
+def parse_rows(fp):
+    rows = [r for r in csv.DictReader(fp)]
+    for row in rows:
+        row['tags'] = row['tags'].split(';')
+    return rows
+
+def load(fp, cache_dir=None):
+    """
+    Load a tagged csv from an open file, reusing the cached parse when the
+    file hasn't changed since it was cached.
+    """
+    file_path = getattr(fp, 'name', None)
+    if not isinstance(file_path, str) or not os.path.isfile(file_path):
+        return TaggedCsv(parse_rows(fp))
+
+    file_path = os.path.abspath(file_path)
+    st = os.stat(file_path)
+    signature = [_CACHE_VERSION, st.st_mtime_ns, st.st_size]
+    cache_dir = cache_dir or get_cache_dir()
+    cache_file = os.path.join(cache_dir, f"{hashlib.sha1(file_path.encode('utf-8')).hexdigest()}.json")
+
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached['signature'] == signature:
+            return TaggedCsv(cached['rows'], cached['index'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    table = TaggedCsv(parse_rows(fp))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{cache_file}.part", 'w') as f:
+            json.dump({
+                'path': file_path,
+                'signature': signature,
+                'rows': table.rows,
+                'index': {tag: sorted(ids) for tag, ids in table.index.items()}
+            }, f)
+        os.replace(f"{cache_file}.part", cache_file)
+    except OSError:
+        # the cache only saves time, a read-only home is fine
+        pass
+    return table
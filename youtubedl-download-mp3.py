@@ -1,16 +1,41 @@
 #!/usr/bin/env python3
 import argparse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from csv import DictReader
 from datetime import datetime, timedelta
+import hashlib
+import json
 import os
 import random
+import shutil
 import subprocess
-from time import sleep
+import tempfile
+from time import monotonic, sleep, time
+from urllib.parse import urlparse
 
 _DEFAULT_DELAY_SECONDS = 211 # 3 minutes 31 seconds
 
 _DEFAULT_DELAY_LEEWAY_SECONDS = 17
 
+_DEFAULT_DOWNLOAD_JOBS = 4
+
+_DEFAULT_STAGING_DIR = os.path.join(tempfile.gettempdir(), 'youtubedl-download-mp3')
+
+_ERRORS_FILE = 'youtubedl-download-mp3.errors'
+
+_LEDGER_FILE = 'youtubedl-download-mp3.ledger.jsonl'
+
+# a failed row is retried after 15 minutes, then 30, 60, ... up to a day
+_RETRY_BACKOFF_SECONDS = 15 * 60
+
+_MAX_RETRY_BACKOFF_SECONDS = 24 * 60 * 60
+
+# hosts that are the same site as far as pacing is concerned
+_HOST_ALIASES = {
+    'youtu.be': 'youtube.com',
+}
+
 _SCRIPT_DESCRIPTION = """
 Read CSV file and use youtube-dl to download videos from specified URLs, extract
 the audio, and save the audio as mp3 file at the specified location with the specified
@@ -25,6 +50,18 @@ with '@', the path that follows is prefixed with '$HOME/Music'. For example,
 if "dir" is '@Dubstep' the actual path would be '$HOME/Music/Dubstep'. If "dir"
 does not being with '@', then the path is check if it is an absolute path or
 relative. If the directory specified by "dir" does not exist, it is created.
+
+Downloads from different sites run at the same time (up to --jobs). Downloads
+from the same site run one at a time, waiting --delay (give or take
+--delay-leeway) seconds between them. Raw audio is downloaded into
+--staging-dir. Converting to mp3 happens in a separate pool of --transcode-jobs
+workers, so it doesn't hold up the next download. The mp3 is written next to its
+final name and renamed into place when complete. Audio that is already mp3 is
+copied without re-encoding unless --bitrate is given.
+
+Every outcome is appended to a ledger (--ledger). Rows whose mp3 was already
+saved are skipped. Failed rows are retried on later runs, waiting longer after
+each failure (--retry-now ignores the wait).
 """
 
 def calculate_delay_time(delay_sec, leeway_sec):
@@ -37,28 +74,191 @@ def calculate_delay_time(delay_sec, leeway_sec):
     return timedelta(seconds=delay_sec + leeway_val)
 
 
-def download_item(url, final_name, final_dir):
+def get_host(url):
+    host = (urlparse(url).hostname or '').lower()
+    # pace by site, not by subdomain (www., m., music. ...)
+    host = '.'.join(host.split('.')[-2:])
+    return _HOST_ALIASES.get(host, host)
+
+
+class Ledger():
+    """
+    Append-only JSON lines record of each row's outcome, keyed by URL and
+    target file. The last line written for a key wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line torn by an interrupted run
+                        continue
+                    self.entries[(entry['url'], entry['target'])] = entry
+                    lines += 1
+
+        if lines > 2 * len(self.entries) + 100:
+            self._compact()
+        self._file = open(path, 'a')
+
+    def _compact(self):
+        with open(f"{self.path}.part", 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(f"{self.path}.part", self.path)
+
+    def is_done(self, url, target):
+        entry = self.entries.get((url, target))
+        return entry is not None and entry['status'] == 'done' and os.path.isfile(target)
+
+    def retry_at(self, url, target):
+        """Wall clock time a failed row may be tried again (0 if it never failed)."""
+        entry = self.entries.get((url, target))
+        if entry is None or entry['status'] != 'failed':
+            return 0
+        backoff = _RETRY_BACKOFF_SECONDS * 2 ** (entry['attempts'] - 1)
+        return entry['time'] + min(backoff, _MAX_RETRY_BACKOFF_SECONDS)
+
+    def record(self, url, target, status, seconds, error=None, file_hash=None):
+        previous = self.entries.get((url, target))
+        attempts = previous['attempts'] + 1 if previous and previous['status'] == 'failed' else 1
+        entry = {
+            'url': url,
+            'target': target,
+            'status': status,
+            'attempts': attempts if status == 'failed' else 0,
+            'time': time(),
+            'seconds': round(seconds, 1),
+            'sha256': file_hash,
+            'error': error,
+        }
+        self.entries[(url, target)] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_target(row):
+    return os.path.join(get_real_final_dir(row['dir']), f"{row['name']}.mp3")
+
+
+def log_error(final_name, url, ex):
+    with open(_ERRORS_FILE, 'a') as f:
+        f.writelines([f"{final_name} ({url}): {ex}\n"])
+
+
+def download_item(url, staging_dir):
+    """
+    Fetch the best audio stream of url into its own directory under
+    staging_dir, without converting it. Returns (success, source file or error).
+    """
     try:
-        if not os.path.exists(final_dir):
-            os.makedirs(final_dir)
+        os.makedirs(staging_dir, exist_ok=True)
 
+        work_dir = tempfile.mkdtemp(prefix='item-', dir=staging_dir)
         ret = subprocess.run(
             [
                 'yt-dlp',
                 '--restrict-filename',
-                '--extract-audio',
-                '--audio-format', 'mp3',
-                url,
-                '--exec', f"mv {{}} {os.path.join(final_dir, final_name)}.mp3"
-            ]
-        )
-        return (
-            ret.returncode == 0,
-            None if ret.returncode == 0 else 'Download failure. See application text.'
+                '--no-progress',
+                '--format', 'bestaudio/best',
+                '--output', os.path.join(work_dir, 'source.%(ext)s'),
+                url
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
         )
+        files = [f for f in os.listdir(work_dir) if not f.endswith('.part')]
+        if ret.returncode != 0 or len(files) != 1:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            output = ret.stdout.strip().splitlines()
+            return (False, f"Download failure. {output[-1] if output else ret.returncode}")
+
+        return (True, os.path.join(work_dir, files[0]))
     except Exception as e:
         return (False, f"Download failure. {e}")
 
+
+def get_audio_codec(source_file):
+    ret = subprocess.run(
+        [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name',
+            '-of', 'csv=p=0',
+            source_file
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+    return ret.stdout.strip() if ret.returncode == 0 else None
+
+
+def transcode_item(source_file, target, bitrate=None):
+    """
+    Convert a downloaded stream to an mp3 at target, then remove the download.
+    An mp3 source is stream copied unless a bitrate is asked for. The mp3 is
+    written to a .part file and renamed, so target is never left half written.
+    Returns (success, error).
+    """
+    part_file = f"{target}.part"
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        if bitrate:
+            codec_args = ['-codec:a', 'libmp3lame', '-b:a', bitrate]
+        elif get_audio_codec(source_file) == 'mp3':
+            codec_args = ['-codec:a', 'copy']
+        else:
+            codec_args = ['-codec:a', 'libmp3lame', '-q:a', '5']
+
+        ret = subprocess.run(
+            [
+                'ffmpeg',
+                '-nostdin',
+                '-y',
+                '-i', source_file,
+                '-vn',
+                *codec_args,
+                '-f', 'mp3',
+                part_file
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        if ret.returncode != 0:
+            output = ret.stderr.strip().splitlines()
+            return (False, f"Transcode failure. {output[-1] if output else ret.returncode}")
+
+        os.replace(part_file, target)
+        return (True, None)
+    except Exception as e:
+        return (False, f"Transcode failure. {e}")
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        shutil.rmtree(os.path.dirname(source_file), ignore_errors=True)
+
+
 def get_real_final_dir(input):
     if input.startswith('@'):
         # substitue "@" with the default root directory: $HOME/Music
@@ -90,46 +290,183 @@ def main():
     # flags
     parser.add_argument(
         '--delay',
-        # type=int,
+        type=int,
         dest='delay',
-        action='store_const',
         default=_DEFAULT_DELAY_SECONDS,
-        help='Number of seconds to wait between each download (for the paranoid).'
+        help='Number of seconds to wait between downloads from the same site (for the paranoid).'
     )
 
     parser.add_argument(
         '--delay-leeway',
-        # type=int,
+        type=int,
         dest='delay_leeway',
-        action='store_const',
         default=_DEFAULT_DELAY_LEEWAY_SECONDS,
         help='Number of seconds higher or lower than --delay to make the wait time somewhat inconsistant.'
     )
 
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        dest='jobs',
+        default=_DEFAULT_DOWNLOAD_JOBS,
+        help=f"Maximum number of downloads (from different sites) at the same time. Default {_DEFAULT_DOWNLOAD_JOBS}."
+    )
+
+    parser.add_argument(
+        '--transcode-jobs',
+        type=int,
+        dest='transcode_jobs',
+        default=os.cpu_count() or 1,
+        help='Number of mp3 conversions to run at the same time. Default is the number of CPUs.'
+    )
+
+    parser.add_argument(
+        '--staging-dir',
+        dest='staging_dir',
+        default=_DEFAULT_STAGING_DIR,
+        help=f"Directory to download raw audio into before it is converted. Default {_DEFAULT_STAGING_DIR}."
+    )
+
+    parser.add_argument(
+        '--bitrate',
+        dest='bitrate',
+        help='Encode at this constant bitrate (e.g. 192k), even if the source is already mp3. '
+             'Default is VBR quality 5, or a straight copy of mp3 sources.'
+    )
+
+    parser.add_argument(
+        '--ledger',
+        dest='ledger',
+        default=_LEDGER_FILE,
+        help=f"File that records the outcome of every row. Default {_LEDGER_FILE}."
+    )
+
+    parser.add_argument(
+        '--retry-now',
+        dest='retry_now',
+        action='store_true',
+        help='Retry failed rows now instead of waiting out their backoff.'
+    )
+
     args = parser.parse_args()
 
     random.seed()
 
     data = [r for r in DictReader(args.File)]
+
+    ledger = Ledger(args.ledger)
+    try:
+        failures = run_downloads(data, args.jobs, args.transcode_jobs, args.delay, args.delay_leeway,
+                                 ledger, args.staging_dir, args.bitrate, args.retry_now)
+    finally:
+        ledger.close()
+
+    if failures:
+        exit(1)
+
+
+def run_downloads(data, jobs, transcode_jobs, delay, delay_leeway, ledger, staging_dir,
+                  bitrate=None, retry_now=False):
+    """
+    Download every row, at most one at a time per host and at most jobs at a
+    time overall. Each host waits delay +/- leeway seconds after a download
+    finishes before starting its next one. Finished downloads are handed to a
+    separate pool for conversion, so a download never waits on an encode.
+
+    Rows the ledger has as saved are skipped, and failed rows are deferred until
+    their backoff has passed. Returns the number of rows that failed.
+    """
+    # rows keep their CSV order within each host
+    pending = {}
+    skipped = 0
+    deferred = 0
+    now = time()
     for idx, row in enumerate(data):
-        url = row['url']
-        final_name = row['name']
-        final_dir = row['dir']
-        final_dir = get_real_final_dir(final_dir)
+        target = get_target(row)
+        if ledger.is_done(row['url'], target):
+            skipped += 1
+            continue
+        if not retry_now and ledger.retry_at(row['url'], target) > now:
+            deferred += 1
+            continue
+        pending.setdefault(get_host(row['url']), deque()).append((idx, row))
+
+    print(f"{len(data) - skipped - deferred} rows to download ({skipped} already saved, {deferred} waiting to retry).")
+
+    started = {}
+
+    ready_at = {host: 0.0 for host in pending}
+    downloads = {}
+    transcodes = {}
+    failures = 0
+    saved = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as download_pool, \
+            ThreadPoolExecutor(max_workers=max(1, transcode_jobs)) as transcode_pool:
+        while pending or downloads or transcodes:
+            now = monotonic()
+            busy = {host for host, _, _ in downloads.values()}
+            for host in list(pending):
+                if len(downloads) >= max(1, jobs):
+                    break
+                if host in busy or ready_at[host] > now:
+                    continue
+
+                idx, row = pending[host].popleft()
+                if not pending[host]:
+                    del pending[host]
 
-        print(f"[{idx + 1}/{len(data)}] Downloading {final_name} ({url}) to {final_dir}.")
+                url = row['url']
+                final_name = row['name']
+                final_dir = get_real_final_dir(row['dir'])
+                print(f"[{idx + 1}/{len(data)}] Downloading {final_name} ({url}) to {final_dir}.")
+                started[idx] = monotonic()
+                future = download_pool.submit(download_item, url, staging_dir)
+                downloads[future] = (host, idx, row)
 
-        success, ex = download_item(url, final_name, final_dir)
+            # wake up for the next finished job or the next host coming off its delay
+            waiting = [ready_at[host] - now for host in pending if host not in busy]
+            timeout = max(0.0, min(waiting)) if waiting and len(downloads) < max(1, jobs) else None
+            if not downloads and not transcodes:
+                # wait() returns at once on an empty list, so sleep out the delay here
+                if timeout:
+                    print(f"Current time: {datetime.now().strftime('%H:%M:%S')}")
+                    print(f"Sleeping until: {(datetime.now() + timedelta(seconds=timeout)).strftime('%H:%M:%S')}")
+                    sleep(timeout)
+                continue
+            done, _ = wait(list(downloads) + list(transcodes), timeout=timeout, return_when=FIRST_COMPLETED)
 
-        if not success:
-            with open('youtubedl-download-mp3.errors', 'a') as f:
-                f.writelines([f"{final_name} ({url}): {ex}"])
+            for future in done:
+                if future in downloads:
+                    host, idx, row = downloads.pop(future)
+                    if delay > 0:
+                        ready_at[host] = monotonic() + calculate_delay_time(delay, delay_leeway).total_seconds()
+                    success, result = future.result()
+                    if not success:
+                        failures += 1
+                        log_error(row['name'], row['url'], result)
+                        ledger.record(row['url'], get_target(row), 'failed', monotonic() - started[idx], error=result)
+                        print(f"[{idx + 1}/{len(data)}] {result}")
+                        continue
+                    transcode = transcode_pool.submit(transcode_item, result, get_target(row), bitrate)
+                    transcodes[transcode] = (idx, row)
+                else:
+                    idx, row = transcodes.pop(future)
+                    success, ex = future.result()
+                    target = get_target(row)
+                    if not success:
+                        failures += 1
+                        log_error(row['name'], row['url'], ex)
+                        ledger.record(row['url'], target, 'failed', monotonic() - started[idx], error=ex)
+                        print(f"[{idx + 1}/{len(data)}] {ex}")
+                    else:
+                        saved += 1
+                        ledger.record(row['url'], target, 'done', monotonic() - started[idx], file_hash=hash_file(target))
+                        print(f"[{idx + 1}/{len(data)}] Saved {row['name']}.mp3")
 
-        if args.delay > 0 and idx < (len(data) - 1):
-            wait_time = calculate_delay_time(args.delay, args.delay_leeway)
-            print(f"Current time: {datetime.now().strftime('%H:%M:%S')}")
-            print(f"Sleeping until: {(datetime.now() + wait_time).strftime('%H:%M:%S')}")
-            sleep(wait_time.seconds)
+    print(f"Summary: {saved} saved, {skipped} already saved, {failures} failed, {deferred} waiting to retry "
+          f"({len(data)} rows).")
+    return failures
 
 if __name__ == '__main__':
     main()